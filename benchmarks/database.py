@@ -0,0 +1,260 @@
+"""
+Benchmarks for the PlyvelDict storage layer.
+
+    python -m benchmarks.database [--backend leveldb|memory] [--quick] [-o out.json]
+    python -m benchmarks.database --compare before.json after.json
+
+Every case runs against a fresh temporary LevelDB and/or the in-memory stand-in from
+`benchmarks.memorydb`, and results are written as JSON (tagged with the current commit)
+so runs from different commits can be compared.
+"""
+
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from itertools import product
+
+from benchmarks.memorydb import MemoryDB
+from utils.database import PlyvelDict
+
+
+@contextmanager
+def leveldb(**options):
+    path = tempfile.mkdtemp(prefix="notus-bench-")
+
+    try:
+        db = PlyvelDict(path, **options)
+        yield db
+        db.close()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def memory(**options):
+    db = PlyvelDict(MemoryDB(), **options)
+    yield db
+    db.close()
+
+
+BACKENDS = {"leveldb": leveldb, "memory": memory}
+
+
+def nested(depth: int, size: int):
+    """Build a value with `depth` levels of dicts above a list of `size` ints."""
+    value = {"items": list(range(size)), "padding": list(range(size))}
+
+    for _ in range(depth - 1):
+        value = {"child": value, "padding": list(range(size))}
+
+    return value
+
+
+def walk(db: PlyvelDict, key: str, depth: int):
+    ref = db[key]
+
+    for _ in range(depth - 1):
+        ref = ref["child"]
+
+    return ref
+
+
+def add_child(db: PlyvelDict, i: int):
+    """Add a container to a top-level dict and change it through the same proxy."""
+    root = db["root"]
+    root[f"child:{i % 10}"] = {"items": [i]}
+    root[f"child:{i % 10}"]["items"].append(i)
+
+
+# name -> (parameter grid, setup(db, params), operation(db, i, params))
+CASES = {
+    "set": (
+        {},
+        lambda db, p: None,
+        lambda db, i, p: db.__setitem__(f"key:{i}", {"n": i, "name": "x" * 16}),
+    ),
+    "set_existing": (
+        {},
+        lambda db, p: db.__setitem__("key", {"n": 0}),
+        lambda db, i, p: db.__setitem__("key", {"n": i}),
+    ),
+    "get": (
+        {"cache_size": [0, 1024]},
+        lambda db, p: [db.__setitem__(f"key:{i}", {"n": i}) for i in range(100)],
+        lambda db, i, p: db[f"key:{i % 100}"],
+    ),
+    "get_large": (
+        {"cache_size": [0, 1024], "size": [1000]},
+        lambda db, p: db.__setitem__("settings", nested(2, p["size"])),
+        lambda db, i, p: db["settings"],
+    ),
+    "contains": (
+        {},
+        lambda db, p: [db.__setitem__(f"key:{i}", i) for i in range(100)],
+        lambda db, i, p: f"key:{i % 200}" in db,
+    ),
+    "len": (
+        {},
+        lambda db, p: [db.__setitem__(f"key:{i}", i) for i in range(1000)],
+        lambda db, i, p: len(db),
+    ),
+    "nested_set": (
+        {"depth": [1, 2, 3], "size": [10, 1000], "flat": [False, True]},
+        lambda db, p: db.__setitem__("root", nested(p["depth"], p["size"])),
+        lambda db, i, p: walk(db, "root", p["depth"])["items"].__setitem__(0, i),
+    ),
+    "nested_append": (
+        {"depth": [1, 3], "size": [10, 1000], "flat": [False, True]},
+        lambda db, p: db.__setitem__("root", nested(p["depth"], p["size"])),
+        lambda db, i, p: walk(db, "root", p["depth"])["items"].append(i),
+    ),
+    "add_child": (
+        {"flat": [False, True]},
+        lambda db, p: db.__setitem__("root", {}),
+        lambda db, i, p: add_child(db, i),
+    ),
+    "iterate_prefix": (
+        {"keys": [1000]},
+        lambda db, p: [
+            db.__setitem__(f"{ns}:{i}", {"n": i})
+            for ns in ("guild", "user")
+            for i in range(p["keys"])
+        ],
+        lambda db, i, p: sum(1 for _ in db.items(prefix="guild:")),
+    ),
+    "iterate_keys": (
+        {"keys": [1000]},
+        lambda db, p: [db.__setitem__(f"key:{i}", i) for i in range(p["keys"])],
+        lambda db, i, p: sum(1 for _ in db.keys()),
+    ),
+}
+
+# Divides the iterations per repeat for cases where one operation touches many keys.
+SCALE = {"iterate_prefix": 50, "iterate_keys": 50}
+STORAGE_OPTIONS = ("cache_size", "flat")
+
+
+def grid(params: dict):
+    names = list(params)
+
+    for values in product(*(params[name] for name in names)):
+        yield dict(zip(names, values))
+
+
+def measure(backend: str, name: str, params: dict, number: int, repeat: int) -> dict:
+    _, setup, operation = CASES[name]
+    options = {k: v for k, v in params.items() if k in STORAGE_OPTIONS}
+    timings = []
+
+    for _ in range(repeat):
+        with BACKENDS[backend](**options) as db:
+            setup(db, params)
+            start = time.perf_counter_ns()
+
+            for i in range(number):
+                operation(db, i, params)
+
+            timings.append((time.perf_counter_ns() - start) / number)
+
+    return {
+        "name": name,
+        "backend": backend,
+        "params": params,
+        "number": number,
+        "repeat": repeat,
+        "ns_per_op": statistics.median(timings),
+        "ns_per_op_min": min(timings),
+    }
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(backends, cases, number: int, repeat: int) -> dict:
+    results = []
+
+    for name in cases:
+        for backend in backends:
+            for params in grid(CASES[name][0]):
+                n = max(1, number // SCALE.get(name, 1))
+                result = measure(backend, name, params, n, repeat)
+                results.append(result)
+
+                print(
+                    f"{name:<16} {backend:<8} {json.dumps(params):<48} "
+                    f"{result['ns_per_op'] / 1000:>10.2f} us/op",
+                    file=sys.stderr,
+                )
+
+    return {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "results": results,
+    }
+
+
+def compare(before: dict, after: dict):
+    def key(result):
+        return result["name"], result["backend"], json.dumps(result["params"])
+
+    old = {key(result): result for result in before["results"]}
+    print(f"{before['commit']} -> {after['commit']}")
+
+    for result in after["results"]:
+        previous = old.get(key(result))
+
+        if previous is None:
+            continue
+
+        ratio = result["ns_per_op"] / previous["ns_per_op"]
+        name, backend, params = key(result)
+        print(
+            f"{name:<16} {backend:<8} {params:<48} "
+            f"{previous['ns_per_op'] / 1000:>10.2f} -> "
+            f"{result['ns_per_op'] / 1000:>10.2f} us/op ({ratio:.2f}x)"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the PlyvelDict layer.")
+    parser.add_argument("--backend", choices=[*BACKENDS, "both"], default="both")
+    parser.add_argument("--case", action="append", choices=list(CASES))
+    parser.add_argument("--number", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--quick", action="store_true", help="fewer iterations")
+    parser.add_argument("-o", "--output", help="write JSON results to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            return compare(json.load(f), json.load(g))
+
+    backends = list(BACKENDS) if args.backend == "both" else [args.backend]
+    number, repeat = (100, 3) if args.quick else (args.number, args.repeat)
+    results = run(backends, args.case or list(CASES), number, repeat)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Checks and timings for `HTTPClient.fetch` and `fetch_image`, against a local server.
+
+    python -m benchmarks.http [--requests 200] [-o out.json]
+
+Starts an aiohttp server on a free local port standing in for image hosts, then checks
+that unchanged bodies are revalidated rather than downloaded again, that oversized and
+non-image responses are given up on early, and that errors are counted per host. Fails
+with an AssertionError if any check doesn't hold. Then times fresh downloads against
+revalidated ones, and reports them as JSON tagged with the current commit.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import sys
+import time
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks.database import commit
+from utils.http import HTTPClient, ResponseTooLarge
+from utils.images import ImageTooLarge, UnsupportedImage, fetch_image
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 256  # 64 KiB
+ETAG = '"v1"'
+LAST_MODIFIED = "Wed, 01 Jan 2020 00:00:00 GMT"
+CHUNK = b"\x89PNG\r\n\x1a\n" + b"\x00" * (64 * 1024 - 8)
+STREAM_CHUNKS = 1024  # 64 MiB, far more than socket buffers hold
+MAX_BYTES = 1024 * 1024
+
+
+class Server:
+    """Local stand-in for image hosts, counting requests and bytes sent per path."""
+
+    def __init__(self):
+        self.requests = Counter()
+        self.sent = Counter()
+        self.url = None
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/etag.png", self.etag)
+        app.router.add_get("/modified.png", self.modified)
+        app.router.add_get("/fresh.png", self.fresh)
+        app.router.add_get("/large.png", self.large)
+        app.router.add_get("/stream.png", self.stream)
+        app.router.add_get("/text", self.text)
+        app.router.add_get("/unavailable", self.unavailable)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def close(self):
+        await self._runner.cleanup()
+
+    def _count(self, request: web.Request, body: bytes = b""):
+        self.requests[request.path] += 1
+        self.sent[request.path] += len(body)
+
+    async def etag(self, request):
+        if request.headers.get("If-None-Match") == ETAG:
+            self._count(request)
+            return web.Response(status=304, headers={"ETag": ETAG})
+
+        self._count(request, PNG)
+        return web.Response(body=PNG, headers={"ETag": ETAG})
+
+    async def modified(self, request):
+        if request.headers.get("If-Modified-Since") == LAST_MODIFIED:
+            self._count(request)
+            return web.Response(status=304)
+
+        self._count(request, PNG)
+        return web.Response(body=PNG, headers={"Last-Modified": LAST_MODIFIED})
+
+    async def fresh(self, request):
+        self._count(request, PNG)
+        return web.Response(body=PNG)
+
+    async def large(self, request):
+        self._count(request)
+        return web.Response(body=CHUNK * (MAX_BYTES // len(CHUNK) + 1))
+
+    async def _stream(self, request, chunk: bytes):
+        """Send `chunk` over and over without a Content-Length, until cut off."""
+        self._count(request)
+        resp = web.StreamResponse()
+        await resp.prepare(request)
+
+        try:
+            for _ in range(STREAM_CHUNKS):
+                await resp.write(chunk)
+                self.sent[request.path] += len(chunk)
+
+            await resp.write_eof()
+        except ConnectionError:
+            pass
+
+        return resp
+
+    async def stream(self, request):
+        return await self._stream(request, CHUNK)
+
+    async def text(self, request):
+        return await self._stream(request, b"not an image " * 5000)
+
+    async def unavailable(self, request):
+        self._count(request)
+        return web.Response(status=503)
+
+
+async def raises(exception, awaitable):
+    try:
+        await awaitable
+    except exception as e:
+        return e
+
+    raise AssertionError(f"{exception.__name__} wasn't raised")
+
+
+async def check(http: HTTPClient, server: Server):
+    """Check the behaviour `fetch` and `fetch_image` promise, against `server`."""
+    url = server.url
+
+    for path in ("/etag.png", "/modified.png"):
+        first, mime = await fetch_image(http, url + path)
+        revalidated = http.revalidated
+        second, _ = await fetch_image(http, url + path)
+        assert first == second == PNG and mime == "image/png", path
+        assert http.revalidated == revalidated + 1, path
+        assert server.requests[path] == 2 and server.sent[path] == len(PNG), path
+
+    # Known from Content-Length, so the body isn't read at all.
+    await raises(ResponseTooLarge, http.fetch(url + "/large.png", MAX_BYTES))
+
+    # Only known while streaming, so reading stops right past the limit.
+    await raises(ImageTooLarge, fetch_image(http, url + "/stream.png", MAX_BYTES))
+    assert server.sent["/stream.png"] < len(CHUNK) * STREAM_CHUNKS / 2
+
+    # Given up on after its first chunk, without a size limit to stop it.
+    await raises(UnsupportedImage, fetch_image(http, url + "/text"))
+    assert server.sent["/text"] < len(CHUNK) * STREAM_CHUNKS / 2
+
+    await raises(aiohttp.ClientResponseError, http.fetch(url + "/unavailable"))
+    stats = http.stats()
+    assert stats["errors"]["127.0.0.1"] == {"503": 1}, stats["errors"]
+    assert stats["hosts"]["127.0.0.1"]["count"] == sum(server.requests.values())
+
+
+async def measure(http: HTTPClient, url: str, number: int) -> dict:
+    timings = []
+
+    for _ in range(number):
+        start = time.perf_counter()
+        await http.fetch(url)
+        timings.append(time.perf_counter() - start)
+
+    return {
+        "number": number,
+        "us_per_fetch": statistics.median(timings) * 1e6,
+        "us_per_fetch_min": min(timings) * 1e6,
+    }
+
+
+async def run(args) -> dict:
+    server = Server()
+    await server.start()
+    http = HTTPClient(timeout=10)
+    await http.start()
+
+    try:
+        await check(http, server)
+        print("checks passed", file=sys.stderr)
+
+        results = {
+            "fresh": await measure(http, server.url + "/fresh.png", args.requests),
+            "revalidated": await measure(http, server.url + "/etag.png", args.requests),
+        }
+
+        for name, result in results.items():
+            print(f"{name:<12} {result['us_per_fetch']:>10.1f} us", file=sys.stderr)
+
+        return {
+            "commit": commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.time(),
+            "body_bytes": len(PNG),
+            "results": results,
+        }
+    finally:
+        await http.close()
+        await server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and time the HTTP client.")
+    parser.add_argument("--requests", type=int, default=200, help="per timing")
+    parser.add_argument("-o", "--output", help="write JSON results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
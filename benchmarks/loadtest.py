@@ -0,0 +1,348 @@
+"""
+Load test of message handling, without connecting to Discord.
+
+    python -m benchmarks.loadtest [--messages 20000] [--mix chat=80,command=15,...]
+    python -m benchmarks.loadtest --tracemalloc -o out.json
+
+Builds a `Notus` on a temporary database with fake guilds, channels and members in
+its connection state, and feeds synthetic messages straight to `on_message`, which
+runs prefix matching, blacklist and throttle checks and command dispatch as usual.
+REST calls made by commands are answered locally, after `--rest-delay` seconds.
+Reports messages per second, latency percentiles per kind of message, and the memory
+allocated, as JSON tagged with the current commit.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from itertools import count
+
+import discord
+
+from benchmarks.database import commit
+from notus import Notus
+from utils.memory import MemoryProfiler
+
+PREFIX = "!"
+BOT_ID = 1
+OWNER_ID = 2
+FIRST_USER_ID = 1000
+
+# Kinds of messages and what they contain, `{}` being replaced with the prefix.
+KINDS = {
+    "chat": "just talking about things, nothing to see here",
+    "command": "{}ping",
+    "prefix": "{}prefix",
+    "unknown": "{}nonexistent command",
+    "blacklisted": "{}ping",
+    "owner": "{}prefix",
+}
+DEFAULT_MIX = "chat=80,command=10,prefix=3,unknown=3,blacklisted=3,owner=1"
+
+
+class FakeREST:
+    """Answer discord.py's REST calls locally, as far as commands need them."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.calls = Counter()
+        self._ids = count(10**15)
+
+    async def request(self, route, *, files=None, form=None, **kwargs):
+        self.calls[f"{route.method} {route.path}"] += 1
+
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+        if route.method == "POST" and route.path.endswith("/messages"):
+            payload = kwargs.get("json") or {}
+            return message_data(
+                next(self._ids),
+                route.channel_id,
+                None,
+                {"id": BOT_ID, "username": "Notus", "bot": True},
+                payload.get("content") or "",
+            )
+
+        return None
+
+
+def user_data(user_id: int) -> dict:
+    return {
+        "id": user_id,
+        "username": f"user{user_id}",
+        "discriminator": "0001",
+        "avatar": None,
+    }
+
+
+def message_data(id_, channel_id, guild_id, author: dict, content: str) -> dict:
+    data = {
+        "id": id_,
+        "channel_id": channel_id,
+        "author": {**user_data(author["id"]), **author},
+        "content": content,
+        "timestamp": "2020-01-01T00:00:00+00:00",
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0,
+    }
+
+    if guild_id is not None:
+        data["guild_id"] = guild_id
+        data["member"] = {"roles": [], "joined_at": data["timestamp"]}
+
+    return data
+
+
+def add_guilds(bot: Notus, guilds: int, channels: int) -> list:
+    """Add guilds to the bot's connection state, returning all their channels."""
+    state = bot._connection
+    found = []
+
+    for i in range(guilds):
+        guild_id = 10**6 + i * 1000
+        guild = state._add_guild_from_data(
+            {
+                "id": guild_id,
+                "name": f"guild{i}",
+                "owner_id": OWNER_ID,
+                "member_count": 1,
+                "roles": [
+                    {"id": guild_id, "name": "@everyone", "permissions": "104324673"}
+                ],
+                "channels": [
+                    {"id": guild_id + j + 1, "type": 0, "name": f"c{j}", "position": j}
+                    for j in range(channels)
+                ],
+                "members": [{"user": {**user_data(BOT_ID), "bot": True}, "roles": []}],
+            }
+        )
+        found += guild.text_channels
+
+    return found
+
+
+def messages(bot: Notus, channels: list, mix: dict, users: int, blacklisted: list):
+    """Endlessly yield `(kind, message)` pairs picked at random according to `mix`."""
+    state = bot._connection
+    kinds, weights = zip(*mix.items())
+    ids = count(10**12)
+    rng = random.Random(0)
+
+    while True:
+        kind = rng.choices(kinds, weights)[0]
+
+        if kind == "blacklisted":
+            author = rng.choice(blacklisted)
+        elif kind == "owner":
+            author = OWNER_ID
+        else:
+            author = FIRST_USER_ID + rng.randrange(users)
+
+        channel = rng.choice(channels)
+        data = message_data(
+            next(ids),
+            channel.id,
+            channel.guild.id,
+            {"id": author},
+            KINDS[kind].format(PREFIX),
+        )
+        yield kind, discord.Message(state=state, channel=channel, data=data)
+
+
+def percentiles(latencies: list) -> dict:
+    if len(latencies) < 2:
+        return {"count": len(latencies)}
+
+    cuts = statistics.quantiles(latencies, n=100)
+    return {
+        "count": len(latencies),
+        "mean_us": statistics.mean(latencies) * 1e6,
+        "p50_us": cuts[49] * 1e6,
+        "p90_us": cuts[89] * 1e6,
+        "p99_us": cuts[98] * 1e6,
+        "max_us": max(latencies) * 1e6,
+    }
+
+
+async def pump(bot: Notus, stream, number: int, concurrency: int) -> dict:
+    """Handle `number` messages from `stream` with `concurrency` at a time."""
+    latencies = defaultdict(list)
+    remaining = number
+
+    async def worker():
+        nonlocal remaining
+
+        while remaining > 0:
+            remaining -= 1
+            kind, message = next(stream)
+            start = time.perf_counter()
+            await bot.on_message(message)
+            latencies[kind].append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+async def loadtest(args) -> dict:
+    path = tempfile.mkdtemp(prefix="notus-loadtest-")
+    config = {
+        "NOTUS_PREFIXES": [PREFIX],
+        "NOTUS_DB_PATH": path,
+        "NOTUS_WATCHDOG_THRESHOLD": 0,
+        "NOTUS_DB_GROUP_COMMIT": args.group_commit,
+    }
+
+    if not args.throttle:
+        # Synthetic traffic is far denser than real traffic, so most would be dropped.
+        config.update(NOTUS_THROTTLE_USER=None, NOTUS_THROTTLE_GUILD=None)
+
+    bot = Notus(config)
+
+    try:
+        rest = FakeREST(args.rest_delay)
+        bot.http.request = rest.request
+        bot.owner_id = OWNER_ID
+        bot._connection.user = discord.ClientUser(
+            state=bot._connection, data={**user_data(BOT_ID), "bot": True}
+        )
+
+        for module in args.module or ["modules.utilities"]:
+            bot.load_extension(module)
+
+        channels = add_guilds(bot, args.guilds, args.channels)
+        blacklisted = [FIRST_USER_ID + args.users + i for i in range(10)]
+
+        for user_id in blacklisted:
+            bot.blacklist.add(user_id)
+
+        mix = {
+            kind: float(weight)
+            for kind, weight in (x.split("=") for x in args.mix.split(","))
+        }
+        stream = messages(bot, channels, mix, args.users, blacklisted)
+        await pump(bot, stream, args.warmup, args.concurrency)
+        rest.calls.clear()
+
+        profiler = MemoryProfiler()
+
+        if args.tracemalloc:
+            profiler.start(args.tracemalloc_frames)
+
+        blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+        latencies = await pump(bot, stream, args.messages, args.concurrency)
+        elapsed = time.perf_counter() - start
+        memory = {
+            "blocks_retained_per_message": (sys.getallocatedblocks() - blocks)
+            / args.messages
+        }
+
+        if args.tracemalloc:
+            memory["traced_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            memory["top"] = profiler.diff(10)
+            profiler.stop()
+
+        return {
+            "commit": commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.time(),
+            "options": {
+                k: v for k, v in vars(args).items() if k not in ("output", "compare")
+            },
+            "messages": args.messages,
+            "seconds": elapsed,
+            "messages_per_second": args.messages / elapsed,
+            "latency": {
+                "all": percentiles([x for xs in latencies.values() for x in xs]),
+                **{kind: percentiles(xs) for kind, xs in sorted(latencies.items())},
+            },
+            "rest_calls": dict(rest.calls),
+            "throttle": bot.throttler.stats(),
+            "memory": memory,
+        }
+    finally:
+        await bot.close()
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def compare(before: dict, after: dict):
+    print(f"{before['commit']} -> {after['commit']}")
+    print(
+        f"{'msg/s':<12} {before['messages_per_second']:>12.0f} -> "
+        f"{after['messages_per_second']:>12.0f} "
+        f"({after['messages_per_second'] / before['messages_per_second']:.2f}x)"
+    )
+
+    for kind, stats in after["latency"].items():
+        previous = before["latency"].get(kind, {})
+
+        if "p50_us" in stats and "p50_us" in previous:
+            print(
+                f"{kind:<12} p50 {previous['p50_us']:>8.1f} -> {stats['p50_us']:>8.1f}"
+                f" us, p99 {previous['p99_us']:>8.1f} -> {stats['p99_us']:>8.1f} us"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test Notus message handling.")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--warmup", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weights of message kinds")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--guilds", type=int, default=10)
+    parser.add_argument("--channels", type=int, default=5, help="per guild")
+    parser.add_argument("--rest-delay", type=float, default=0)
+    parser.add_argument("--group-commit", type=float, default=0)
+    parser.add_argument("--throttle", action="store_true", help="keep rate limits on")
+    parser.add_argument("--module", action="append", help="default modules.utilities")
+    parser.add_argument("--tracemalloc", action="store_true")
+    parser.add_argument("--tracemalloc-frames", type=int, default=1)
+    parser.add_argument("-o", "--output", help="write JSON results to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            return compare(json.load(f), json.load(g))
+
+    unknown = {x.split("=")[0] for x in args.mix.split(",")} - set(KINDS)
+
+    if unknown:
+        parser.error(f"unknown message kinds: {', '.join(sorted(unknown))}")
+
+    results = asyncio.run(loadtest(args))
+    print(
+        f"{results['messages_per_second']:.0f} messages/s, "
+        f"p50 {results['latency']['all']['p50_us']:.1f} us, "
+        f"p99 {results['latency']['all']['p99_us']:.1f} us",
+        file=sys.stderr,
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
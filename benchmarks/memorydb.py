@@ -0,0 +1,135 @@
+"""
+Pure Python, in-memory stand-in for `plyvel.DB`, implementing the parts `PlyvelDict`
+uses. Lets the storage layer be measured or driven without disk I/O:
+
+    PlyvelDict(MemoryDB())
+"""
+
+from bisect import bisect_left, insort
+
+
+def _upper_bound(prefix: bytes) -> bytes:
+    """Smallest key greater than every key starting with `prefix`, or None."""
+    prefix = prefix.rstrip(b"\xff")
+    return prefix[:-1] + bytes([prefix[-1] + 1]) if prefix else None
+
+
+class _Reader:
+    def __init__(self, data: dict, keys: list):
+        self._data = data
+        self._keys = keys
+
+    def get(self, key: bytes, default=None):
+        return self._data.get(key, default)
+
+    def iterator(
+        self,
+        reverse=False,
+        start=None,
+        stop=None,
+        include_start=True,
+        include_stop=False,
+        prefix=None,
+        include_key=True,
+        include_value=True,
+    ):
+        if prefix is not None:
+            if start is not None or stop is not None:
+                raise TypeError(
+                    "'prefix' cannot be used together with 'start' or 'stop'"
+                )
+
+            start, stop = prefix, _upper_bound(prefix)
+
+        lo = 0 if start is None else bisect_left(self._keys, start)
+        hi = len(self._keys) if stop is None else bisect_left(self._keys, stop)
+
+        if start is not None and not include_start:
+            lo += lo < hi and self._keys[lo] == start
+        if stop is not None and include_stop:
+            hi += hi < len(self._keys) and self._keys[hi] == stop
+
+        keys = self._keys[lo:hi]  # Copy, so writes don't disturb iteration
+
+        for key in reversed(keys) if reverse else keys:
+            if include_key and include_value:
+                yield key, self._data[key]
+            elif include_key:
+                yield key
+            else:
+                yield self._data[key]
+
+
+class _Snapshot(_Reader):
+    def close(self):
+        pass
+
+
+class _WriteBatch:
+    def __init__(self, db: "MemoryDB", transaction: bool):
+        self._db = db
+        self._transaction = transaction
+        self._ops = []
+
+    def put(self, key: bytes, value: bytes):
+        self._ops.append((key, value))
+
+    def delete(self, key: bytes):
+        self._ops.append((key, None))
+
+    def clear(self):
+        self._ops.clear()
+
+    def write(self):
+        for key, value in self._ops:
+            if value is None:
+                self._db.delete(key)
+            else:
+                self._db.put(key, value)
+
+        self._ops.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None or not self._transaction:
+            self.write()
+
+
+class MemoryDB(_Reader):
+    def __init__(self, name: str = "<memory>"):
+        super().__init__({}, [])
+        self.name = name
+        self.closed = False
+
+    def put(self, key: bytes, value: bytes):
+        if key not in self._data:
+            insort(self._keys, key)
+
+        self._data[key] = value
+
+    def delete(self, key: bytes):
+        if self._data.pop(key, None) is not None:
+            del self._keys[bisect_left(self._keys, key)]
+
+    def write_batch(self, transaction=False):
+        return _WriteBatch(self, transaction)
+
+    def snapshot(self):
+        return _Snapshot(dict(self._data), list(self._keys))
+
+    def approximate_size(self, start: bytes, stop: bytes) -> int:
+        return sum(
+            len(key) + len(self._data[key])
+            for key in self.iterator(start=start, stop=stop, include_value=False)
+        )
+
+    def approximate_sizes(self, *ranges):
+        return [self.approximate_size(start, stop) for start, stop in ranges]
+
+    def compact_range(self, start=None, stop=None):
+        pass
+
+    def close(self):
+        self.closed = True
@@ -1,36 +1,46 @@
+import io
+import os
+import re
+import resource
 import time
-import traceback
+import tracemalloc
+from functools import partial
 from inspect import cleandoc
 from textwrap import indent
 from typing import TYPE_CHECKING
 
+import discord
 from discord.ext import commands
 
+from utils import backup as backups
 from utils import check
+from utils.memory import MemoryProfiler, cache_sizes
+from utils.sandbox import Sandbox, SandboxError
 
 if TYPE_CHECKING:
     from notus import Notus
 
 
 class Core(commands.Cog):
-    def __init__(self, notus: Notus):
+    def __init__(self, notus: "Notus"):
         self.notus = notus
 
-        if "modules" not in self.settings:
-            self.settings["modules"] = []
-
         if "eval" not in self.notus.db:
             self.notus.db["eval"] = {"env": {}, "count": 0}
 
-        for module in self.settings["modules"]:
-            if module not in self.notus.extensions:
-                try:
-                    self.notus.load_extension(module)
-                except Exception as e:
-                    self.settings["modules"].remove(module)
+        config = notus.config
+        self.backup_dir = config.get("NOTUS_BACKUP_DIR", "./backups")
+        self.sandbox = Sandbox(
+            config.get("NOTUS_EVAL_WORKERS", 2),
+            config.get("NOTUS_EVAL_TIMEOUT", 10),
+            config.get("NOTUS_EVAL_MEMORY", 512 << 20),
+        )
+        notus.loop.create_task(self.sandbox.start())
+        self.profiler = MemoryProfiler(config.get("NOTUS_MEMORY_DIR", "./memory"))
 
-                    print(f"Extension `{module}` blew up.")
-                    print("".join(traceback.format_tb(e.__traceback__)))
+        if config.get("NOTUS_MEMORY_DUMP_INTERVAL"):
+            self.profiler.start()
+            self.profiler.start_dumps(config["NOTUS_MEMORY_DUMP_INTERVAL"])
 
     @property
     def settings(self):
@@ -87,105 +97,344 @@ class Core(commands.Cog):
                 "Try using `module load <name>` instead."
             )
 
+    @commands.group("db", invoke_without_command=True)
+    @check.owner()
+    async def db(self, ctx: commands.Context):
+        """Database statistics"""
+        stats = self.notus.db.stats()
+        cache = stats["cache"]
+        lookups = cache["hits"] + cache["misses"]
+        lines = [
+            f"Keys: {stats['keys']}",
+            f"Size: ~{stats['approximate_bytes'] // 1024} KiB on disk",
+            f"Pending writes: {stats['pending_writes']}",
+            f"Cache: {cache['currsize']} entries, {cache['currbytes'] // 1024} KiB, "
+            f"{cache['hits'] / lookups if lookups else 0:.1%} hit rate",
+            "",
+        ]
+        lines += [
+            f"{ns:<24} {info['keys']:>8} keys ~{info['approximate_bytes'] // 1024} KiB"
+            for ns, info in sorted(
+                stats["namespaces"].items(), key=lambda x: -x[1]["keys"]
+            )[:20]
+        ]
+
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    @db.command("recount")
+    async def db_recount(self, ctx: commands.Context):
+        """Count the keys again with a full scan, fixing the stored counts"""
+        before = len(self.notus.db)
+
+        async with ctx.typing():
+            await self.notus.adb.run(self.notus.db.recount)
+
+        await ctx.send(f"Recounted {len(self.notus.db)} keys, {before} before.")
+
+    @db.command("timings")
+    async def db_timings(self, ctx: commands.Context, action: str = None):
+        """Show database operation timings, or turn them `on`, `off` or `reset` them"""
+        db = self.notus.db
+
+        if action == "on":
+            db.enable_metrics()
+            return await ctx.send("Recording database timings.")
+        elif action == "off":
+            db.disable_metrics()
+            return await ctx.send("Stopped recording database timings.")
+        elif action == "reset" and db.metrics:
+            db.metrics.reset()
+            return await ctx.send("Database timings reset.")
+        elif action:
+            return await ctx.send("Must be one of `on`, `off` or `reset`.")
+        elif not db.metrics:
+            return await ctx.send("Timings aren't being recorded, use `db timings on`.")
+
+        report = db.metrics.report()
+        lines = [
+            f"Since {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(report['since']))}",
+            "",
+            f"{'Operation':<12} {'Count':>8} {'Total ms':>10} {'Mean us':>9} "
+            f"{'p99 us':>8} {'KiB':>8}",
+        ]
+
+        for op, info in sorted(report["operations"].items()):
+            lines.append(
+                f"{op:<12} {info['count']:>8} {info['seconds'] * 1000:>10.1f} "
+                f"{info['mean'] * 1e6:>9.1f} {info['p99'] * 1e6:>8.0f} "
+                f"{info['bytes'] // 1024:>8}"
+            )
+
+        keys = sorted(
+            report["keys"].items(),
+            key=lambda x: -sum(info["seconds"] for info in x[1].values()),
+        )
+        lines += ["", "Slowest keys:"]
+        lines += [
+            f"{key[:32]:<32} {sum(i['seconds'] for i in ops.values()) * 1000:>8.1f} ms"
+            for key, ops in keys[:10]
+        ]
+
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    @commands.group(invoke_without_command=True)
+    @check.owner()
+    async def backup(self, ctx: commands.Context):
+        """Back up the database without stopping the bot"""
+        os.makedirs(self.backup_dir, exist_ok=True)
+        name = time.strftime("notus-%Y%m%d-%H%M%S.ndb.gz")
+
+        async with ctx.typing():
+            stats = await self.notus.adb.run(
+                backups.backup, self.notus.db, os.path.join(self.backup_dir, name)
+            )
+
+        await ctx.send(
+            f"Backed up {stats['keys']} keys to `{name}` "
+            f"({stats['bytes'] // 1024} KiB, {stats['seconds']:.2f}s)."
+        )
+
+    @backup.command("list")
+    async def backup_list(self, ctx: commands.Context):
+        """List saved backups"""
+        if not os.path.isdir(self.backup_dir):
+            return await ctx.send("No backups yet.")
+
+        names = sorted(x for x in os.listdir(self.backup_dir) if x.endswith(".ndb.gz"))
+        lines = [
+            f"{x} ({os.path.getsize(os.path.join(self.backup_dir, x)) // 1024} KiB)"
+            for x in names[-20:]
+        ]
+        await ctx.send("```\n" + ("\n".join(lines) or "No backups yet.") + "\n```")
+
+    @backup.command("restore")
+    async def backup_restore(self, ctx: commands.Context, name: str):
+        """Replace the database with a backup, backing up the current one first"""
+        path = os.path.join(self.backup_dir, os.path.basename(name))
+
+        if not os.path.isfile(path):
+            return await ctx.send("No backup with that name.")
+
+        async with ctx.typing():
+            try:
+                await self.notus.adb.run(backups.verify, path)
+            except (backups.BackupError, OSError) as e:
+                return await ctx.send(f"Can't restore that backup: {e}")
+
+            before = os.path.join(
+                self.backup_dir, time.strftime("pre-restore-%Y%m%d-%H%M%S.ndb.gz")
+            )
+            await self.notus.adb.run(backups.backup, self.notus.db, before)
+            stats = await self.notus.adb.run(backups.restore, self.notus.db, path)
+
+        await ctx.send(
+            f"Restored {stats['keys']} keys in {stats['seconds']:.2f}s. The previous "
+            f"data was saved as `{os.path.basename(before)}`. Restart to make sure "
+            f"nothing keeps state read before the restore."
+        )
+
+    @commands.command()
+    @check.owner()
+    async def startup(self, ctx: commands.Context):
+        """Show how long each phase of startup took"""
+        await ctx.send(f"```\n{self.notus.timings.report()}\n```")
+
+    @commands.command()
+    @check.owner()
+    async def throttle(self, ctx: commands.Context):
+        """Show how many commands were dropped for going over rate limits"""
+        stats = self.notus.throttler.stats()
+        lines = [f"Dropped ({x}): {n}" for x, n in sorted(stats["dropped"].items())]
+        lines += [f"Tracked {x} buckets: {n}" for x, n in stats["buckets"].items()]
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
     @commands.command()
-    @check.instance_owner()
+    @check.owner()
+    async def http(self, ctx: commands.Context):
+        """Show latency and errors of outgoing HTTP requests per host"""
+        stats = self.notus.web.stats()
+        lines = [
+            f"{host}: {x['count']} requests, p50 {x['p50'] * 1000:.0f}ms, "
+            f"p99 {x['p99'] * 1000:.0f}ms, {x['bytes']} bytes"
+            for host, x in sorted(stats["hosts"].items())
+        ]
+        lines += [
+            f"{host} errors: {', '.join(f'{e} x{n}' for e, n in errors.items())}"
+            for host, errors in sorted(stats["errors"].items())
+        ]
+        lines.append(f"Revalidated from cache: {stats['revalidated']}")
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    @commands.command()
+    @check.owner()
+    async def lag(self, ctx: commands.Context, action: str = None):
+        """Show event loop lag and the code blocking it the most, or `reset` them"""
+        watchdog = self.notus.watchdog
+
+        if action == "reset":
+            watchdog.reset()
+            return await ctx.send("Loop lag statistics reset.")
+        elif action:
+            return await ctx.send("Only `reset` is supported.")
+        elif not watchdog.running:
+            return await ctx.send("The watchdog is off, see NOTUS_WATCHDOG_THRESHOLD.")
+
+        report = watchdog.report()
+
+        if len(report) > 1990:
+            data = io.BytesIO(report.encode())
+            return await ctx.send("Loop lag report", file=discord.File(data, "lag.txt"))
+
+        await ctx.send(f"```\n{report}\n```")
+
+    @commands.group(invoke_without_command=True)
+    @check.owner()
+    async def memory(self, ctx: commands.Context):
+        """Show memory use and the size of the bot's caches"""
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+        lines = [f"Peak RSS: {rss} MiB"]
+
+        if self.profiler.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(
+                f"Traced: {current >> 20} MiB now, {peak >> 20} MiB peak"
+                f"{', dumping snapshots' if self.profiler.dumping else ''}"
+            )
+        else:
+            lines.append("Not tracing, use `memory start`.")
+
+        lines.append("")
+        lines += [f"{x:<18} {size}" for x, size in cache_sizes(self.notus).items()]
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    @memory.command("start")
+    async def memory_start(self, ctx: commands.Context, frames: int = 1):
+        """Start tracing allocations, which slows everything down a bit"""
+        # Takes a snapshot to compare to, which is slow when already tracing.
+        await self.notus.loop.run_in_executor(
+            None, self.profiler.start, max(1, min(frames, 25))
+        )
+        await ctx.send("Tracing allocations.")
+
+    @memory.command("stop")
+    async def memory_stop(self, ctx: commands.Context):
+        """Stop tracing allocations and dumping snapshots"""
+        self.profiler.stop()
+        await ctx.send("Stopped tracing allocations.")
+
+    @memory.command("top")
+    async def memory_top(self, ctx: commands.Context, limit: int = 10):
+        """Show where most of the traced memory was allocated"""
+        if not self.profiler.tracing:
+            return await ctx.send("Not tracing, use `memory start`.")
+
+        lines = await self.notus.loop.run_in_executor(
+            None, self.profiler.top, min(limit, 25)
+        )
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    @memory.command("diff")
+    async def memory_diff(self, ctx: commands.Context, limit: int = 10):
+        """Show where memory use grew since the last diff or `memory start`"""
+        if not self.profiler.tracing:
+            return await ctx.send("Not tracing, use `memory start`.")
+
+        lines = await self.notus.loop.run_in_executor(
+            None, partial(self.profiler.diff, min(limit, 25), mark=True)
+        )
+        await ctx.send("```\n" + ("\n".join(lines) or "No change.") + "\n```")
+
+    @memory.command("dump")
+    async def memory_dump(self, ctx: commands.Context, interval: float = None):
+        """Save a snapshot to disk, or one every `interval` seconds (0 to stop)"""
+        if not self.profiler.tracing:
+            return await ctx.send("Not tracing, use `memory start`.")
+
+        if interval == 0:
+            self.profiler.stop_dumps()
+            return await ctx.send("Stopped dumping snapshots.")
+        elif interval is not None:
+            self.profiler.start_dumps(max(interval, 60))
+            return await ctx.send(
+                f"Dumping a snapshot to `{self.profiler.directory}` every "
+                f"{max(interval, 60):.0f}s."
+            )
+
+        path = await self.notus.loop.run_in_executor(None, self.profiler.dump)
+        await ctx.send(f"Saved `{path}`, compare with `python -m utils.memory`.")
+
+    @commands.command()
+    @check.owner()
     async def arguments(self, ctx):
         """Lists all arguments."""
         await ctx.send(
             "Arguments for modules include: `load, unload & reload`.")
 
     @commands.command(aliases=['kys'])
-    @check.instance_owner()
+    @check.owner()
     async def shutdown(self, ctx):
         """Shuts down the bot.... Duh."""
         await ctx.send("Logging out...")
         await self.notus.logout()
 
-# Now this piece of shit code is partially broken.
-# Large output evals used to upload to pastebin but their API is now private.
-# Instead large output evals are not printed at all thus causing a problem when debugging.
-# Temporarily disabled until fixed.
-# Also leaving that one to @Ovyerus because my last 6 attempts at fixing it failed.
-
-    @commands.command(aliases=['debug'], usage='<code>')
-    @check.instance_owner()
-    async def eval(self, ctx):
-        await ctx.send("This command is currently disabled.")
-#        if self._eval.get('env') is None:
-#            self._eval['env'] = {}
-#        if self._eval.get('count') is None:
-#            self._eval['count'] = 0
-#
-#        self._eval['env'].update({
-#            'ctx': ctx,
-#            'message': ctx.msg,
-#            'channel': ctx.msg.channel,
-#            'guild': ctx.msg.guild,
-#            'server': ctx.msg.guild,
-#            'author': ctx.msg.author
-#        })
-#
-        # let's make this safe to work with
-#        code = ctx.suffix.replace('```py\n', '').replace('```', '').replace('`', '')
-#        _code = "async def func(self):\n  try:\n{}\n  finally:\n    self._eval['env'].update(locals())"\
-#                .format(textwrap.indent(code, '    '))
-#        before = time.monotonic()
-#
-        # noinspection PyBroadException
-#        try:
-#            exec(_code, self._eval['env'])
-#
-#            func = self._eval['env']['func']
-#            output = await func(self)
-#
-#            if output is not None:
-#                output = repr(output)
-#        except Exception as e:
-#            output = '{}: {}'.format(type(e).__name__, e)
-#
-#        after = time.monotonic()
-#        self._eval['count'] += 1
-#        count = self._eval['count']
-#        code = code.split('\n')
-#
-#        if len(code) == 1:
-#            _in = 'In [{}]: {}'.format(count, code[0])
-#        else:
-#            _first_line = code[0]
-#            _rest = code[1:]
-#            _rest = '\n'.join(_rest)
-#            _countlen = len(str(count)) + 2
-#            _rest = textwrap.indent(_rest, '...: ')
-#            _rest = textwrap.indent(_rest, ' ' * _countlen)
-#            _in = 'In [{}]: {}\n{}'.format(count, _first_line, _rest)
-#
-#        message = '```py\n{}'.format(_in)
-#        ms = int(round((after - before) * 1000))
-#
-#        if output is not None:
-#            message += '\nOut[{}]: {}'.format(count, output)
-#
-#        if ms > 100:  # noticeable delay
-#            message += '\n# {} ms\n```'.format(ms)
-#        else:
-#            message += '\n```'
-#
-#        try:
-#            if ctx.msg.author.id == self.notus.user.id:
-#                await ctx.msg.edit(content=message)
-#            else:
-#                await ctx.send(message)
-#        except discord.HTTPException:
-#            await ctx.msg.channel.trigger_typing()
-#            await ctx.send('Output was too big to be printed.')
-
-        # Eval code provided by Pandentia over at Thessia.
-        # More of his work here: https://github.com/Pandentia
-
-# Sidenote, uncommenting all of this is gonna be fun, goodluck Ovy.
+    @commands.command(aliases=["debug"], usage="<code>")
+    @check.owner()
+    async def eval(self, ctx: commands.Context, *, code: str):
+        """Evaluate Python code in a sandboxed worker process"""
+        fenced = re.fullmatch(r"```(?:py(?:thon)?\n)?(.*?)```", code.strip(), re.S)
+        code = fenced.group(1).strip() if fenced else code.strip("` \n")
+        env = self.eval_data["env"].get(ctx.author.id)
+
+        async with ctx.typing():
+            try:
+                result = await self.sandbox.run(
+                    code,
+                    env,
+                    author_id=ctx.author.id,
+                    channel_id=ctx.channel.id,
+                    guild_id=ctx.guild and ctx.guild.id,
+                )
+            except SandboxError as e:
+                return await ctx.send(f"Error: {e}")
+
+        def record(data):
+            data["env"][ctx.author.id] = result.env
+            data["count"] += 1
+            return data
 
+        # Shards may evaluate at the same time, so count as one change.
+        data = await self.notus.adb.run(self.notus.db.modify, "eval", record)
+        count = data["count"]
+
+        first, *rest = code.split("\n")
+        lines = [f"In [{count}]: {first}"]
+
+        if rest:
+            lines.append(indent("\n".join(rest), " " * (len(str(count)) + 2) + "...: "))
+        if result.output:
+            lines.append(result.output.rstrip("\n"))
+        if result.error:
+            lines.append(result.error.rstrip("\n"))
+        elif result.value is not None:
+            lines.append(f"Out[{count}]: {result.value}")
+        if result.seconds > 0.1:  # noticeable delay
+            lines.append(f"# {result.seconds * 1000:.0f} ms")
+
+        text = "\n".join(lines)
+        message = f"```py\n{text}\n```"
+
+        if len(message) <= 2000:
+            await ctx.send(message)
+        else:
+            await ctx.send(
+                f"Output of `In [{count}]` is {len(text)} characters long.",
+                file=discord.File(io.BytesIO(text.encode()), f"eval-{count}.txt"),
+            )
 
+    def cog_unload(self):
+        self.sandbox.close()
+        self.profiler.stop_dumps()
 
 
 def setup(notus):
-    notus.add_cog(Core())
+    notus.add_cog(Core(notus))
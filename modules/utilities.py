@@ -1,15 +1,27 @@
-import asyncio
-import mimetypes
+import io
 from typing import TYPE_CHECKING, List
 
+import aiohttp
 import discord
 from discord.ext import commands
 
 from utils import check
+from utils.cleanup import purge
+from utils.images import (
+    AVATAR_MAX_BYTES,
+    AVATAR_MAX_SIZE,
+    ImageCache,
+    ImageError,
+    fetch_image,
+    shrink,
+)
 
 if TYPE_CHECKING:
     from notus import Notus
 
+# Longer blacklists are sent as a file rather than several pages of messages.
+MAX_LISTED = 200
+
 
 class MultiStringConverter(commands.Converter):
     def __init__(self, *strings: List[str]):
@@ -23,31 +35,23 @@ class MultiStringConverter(commands.Converter):
 
 
 class Utilities(commands.Cog):
-    def __init__(self, notus: Notus):
+    def __init__(self, notus: "Notus"):
         self.notus = notus
-
-    @property
-    def settings(self):
-        return self.notus.db["settings"]
+        self.avatars = ImageCache(notus.db, "avatars")
+        # Going through history takes a request per 100 messages, so only moderators
+        # can clean up further back than this.
+        self.cleanup_limit = notus.config.get("NOTUS_CLEANUP_LIMIT", 100)
 
     @commands.command()
     async def ping(self, ctx: commands.Context):
         """Pong"""
         await ctx.send("Pong.")
 
-
-    @commands.group(name='set') # Needs testing.
-    @check.instance_owner()
-    async def utils_set(self, ctx):
-        """Sets various stuff."""
-        await self.notus.send_command_help(ctx)
-
     @commands.group("set", invoke_without_command=True)
     @check.owner()
     async def set_(self, ctx: commands.Context):
         await ctx.send_help(ctx.command)
 
-
     @set_.command("nickname", aliases=["nick"])
     @check.permissions.me(discord.Permissions(change_nickname=True))
     async def set_nickname(self, ctx: commands.Context, nickname: str):
@@ -86,47 +90,40 @@ class Utilities(commands.Cog):
         elif not url:
             url = ctx.message.attachments[0].url
 
-        ext = url.split(".")[-1]
-        mime = mimetypes.types_map.get(ext)
+        async with ctx.typing():
+            try:
+                # Revalidated against the last download, so unchanged images are cheap.
+                data, _ = await fetch_image(self.notus.web, url)
+            except ImageError as e:
+                return await ctx.send(str(e))
+            except aiohttp.ClientError:
+                return await ctx.send("Failed to download avatar.")
 
-        if mime not in ("image/png", "image/jpeg", "image/webp"):
-            return await ctx.send(f"Unsupported mimetype `{mime}`")
+            digest = self.avatars.digest(data)
 
-        async with ctx.typing():
-            async with self.notus.session.get(url) as resp:
-                data = await resp.read()
+            if digest == await self.notus.adb.run(self.avatars.current):
+                return await ctx.send(":thumbsup:")
+
+            prepared = await self.notus.adb.run(self.avatars.get, digest)
+
+            if prepared is None:
+                try:
+                    prepared = await self.notus.loop.run_in_executor(
+                        None, shrink, data, AVATAR_MAX_BYTES, AVATAR_MAX_SIZE
+                    )
+                except ImageError as e:
+                    return await ctx.send(str(e))
+
+                await self.notus.adb.run(self.avatars.put, digest, prepared)
 
             try:
-                await self.notus.user.edit(avatar=data)
+                await self.notus.user.edit(avatar=prepared)
             except Exception:
                 return await ctx.send("Failed to set avatar.")
 
-        await ctx.send(":thumbsup:")
+            await self.notus.adb.run(self.avatars.set_current, digest)
 
-            try:
-                await self.notus.user.edit(avatar=content)
-            except BaseException:  # I don't know the exact Exception type
-                return await ctx.send("Avatar was too big or not an image!")
-
-        await ctx.send("Successfully updated avatar!")
-
-    @commands.group(name="blacklist") # also needs testing
-    @check.instance_owner()
-    async def blacklist_commands(self, ctx):
-        """Prevents a user from using the bot globally."""
-        await self.notus.send_command_help(ctx)
-
-    @blacklist_commands.command(name="add")
-    async def add_blacklist(self, ctx, *, user: discord.Member):
-        """Adds a user to blacklist."""
-        if str(user.id) not in self.settings['blacklist']:
-            try:
-                self.settings['blacklist'].append(str(user.id))
-                await ctx.send("User blacklisted.")
-            except:
-                await ctx.send("An error occured.")
-        else:
-            await ctx.send("User already blacklisted.")
+        await ctx.send(":thumbsup:")
 
     @commands.group(invoke_without_command=True)
     @check.owner()
@@ -134,76 +131,99 @@ class Utilities(commands.Cog):
         """Prevent a user from using the bot at all"""
         await ctx.send_help(ctx.command)
 
-
     @blacklist.command("list")
     async def blacklist_list(self, ctx: commands.Context):
         """List all currently blacklisted users"""
-        users = [self.notus.get_user(x) or x for x in self.settings["blacklist"]]
+        if not self.notus.blacklist:
+            return await ctx.send("No users are blacklisted.")
 
-        for i, user in enumerate(users):
-            if not isinstance(user, int):
-                pass
+        async with ctx.typing():
+            users = await self.notus.user_resolver.resolve_many(
+                sorted(self.notus.blacklist)
+            )
 
+        if len(users) > MAX_LISTED:
+            lines = (f"{name or 'Unknown user'} ({id_})" for id_, name in users.items())
+            data = io.BytesIO("\n".join(lines).encode())
+            return await ctx.send(
+                f"__Currently blacklisted users__ ({len(users)})",
+                file=discord.File(data, "blacklist.txt"),
+            )
 
-    @commands.command(aliases=['clean'])
-    @check.instance_guild()
-    async def cleanup(self, ctx):
-        """Cleans up the bot's messages."""
-        msgs = await ctx.msg.channel.history(limit=100).flatten()
-        msgs = [msg for msg in msgs if msg.author.id == self.notus.user.id]
+        paginator = commands.Paginator(prefix="", suffix="")
+        paginator.add_line("__Currently blacklisted users__")
 
-            try:
-                user = await self.notus.fetch_user(user)
-                users[i] = user
-            except discord.DiscordException:
-                users[i] = f"**Unknown user** ({user})"
-
-        users = [
-            (
-                f"**{user.name}#{user.discriminator}** ({user.id})"
-                if isinstance(x, discord.User)
-                else x
-            )
-            for x in users
-        ]
+        for id_, name in users.items():
+            name = discord.utils.escape_markdown(name) if name else "Unknown user"
+            paginator.add_line(f"**{name}** ({id_})")
 
-        await ctx.send("__Currently blacklisted users__\n" + "\n".join(users))
+        for page in paginator.pages:
+            await ctx.send(page)
 
     @blacklist.command("add")
     async def blacklist_add(self, ctx: commands.Context, user: discord.User):
         """Add a user to the blacklist"""
-        if user.id in self.settings["blacklist"]:
+        if user.id in self.notus.blacklist:
             return await ctx.send("User already blacklisted.")
 
-        self.settings["blacklist"].append(user.id)
+        self.notus.blacklist.add(user.id)
         await ctx.send("User blacklisted.")
 
     @blacklist.command("remove")
     async def blacklist_remove(self, ctx: commands.Context, user: discord.User):
         """Remove a user from the blacklist"""
-        if user.id not in self.settings["blacklist"]:
+        if user.id not in self.notus.blacklist:
             return await ctx.send("User is not blacklisted")
 
-        self.settings["blacklist"].remove(user.id)
+        self.notus.blacklist.discard(user.id)
         await ctx.send("User removed from blacklist.")
 
+    @commands.group(invoke_without_command=True)
+    async def prefix(self, ctx: commands.Context):
+        """Show the command prefixes used here"""
+        prefixes = self.notus.prefixes.get(ctx.guild and ctx.guild.id)
+        await ctx.send(", ".join(f"`{x}`" for x in prefixes) or "No prefixes set.")
+
+    @prefix.command("set")
+    @check.permissions.author(discord.Permissions(manage_guild=True))
+    async def prefix_set(self, ctx: commands.Context, *prefixes: str):
+        """Set the command prefixes for this server"""
+        if not prefixes:
+            return await ctx.send("Please give at least one prefix.")
+
+        self.notus.prefixes.set(ctx.guild.id, prefixes)
+        await ctx.send(":thumbsup:")
+
+    @prefix.command("reset")
+    @check.permissions.author(discord.Permissions(manage_guild=True))
+    async def prefix_reset(self, ctx: commands.Context):
+        """Go back to the default command prefixes for this server"""
+        self.notus.prefixes.reset(ctx.guild.id)
+        await ctx.send(":thumbsup:")
+
     @commands.command(aliases=["clean"])
     @check.guild()
-    async def cleanup(self, ctx: commands.Command):
-        """Clean up the bot's messages"""
-        msgs = await ctx.channel.history(limit=100).flatten()
-        msgs = [x for x in msgs if x.author.id == self.notus.user.id]
+    async def cleanup(self, ctx: commands.Context, limit: int = 100):
+        """Clean up the bot's messages among the last `limit` messages"""
+        author = self.notus.permission_cache.get(ctx.author, ctx.channel)
 
-        if not msgs:
-            return
+        if limit > self.cleanup_limit and not author.manage_messages:
+            return await ctx.send(
+                f"Only moderators can clean up past {self.cleanup_limit} messages."
+            )
 
-        if ctx.me.permissions_in(ctx.channel).manage_messages:
-            await ctx.msg.channel.delete_messages(msgs)
-        else:
-            for msg in msgs:
-                await msg.delete()
-                await asyncio.sleep(1.3)  # Try to avoid getting ratelimited
+        limit = max(1, limit)
+
+        async with ctx.typing():
+            bulk, single = await purge(
+                ctx.channel,
+                lambda x: x.author.id == self.notus.user.id,
+                limit=limit,
+                bulk=ctx.me.permissions_in(ctx.channel).manage_messages,
+            )
+
+        await ctx.send(f"Deleted {bulk + single} messages.", delete_after=5)
 
 
 def setup(notus):
-    notus.add_cog(Utilities)
+    notus.add_cog(Utilities(notus))
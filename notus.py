@@ -1,61 +1,161 @@
 import json
+import os
+import time
 import traceback
+from typing import Set
 
-import aiohttp
 import discord.ext.commands as discord
 from discord import utils as dutils
 
-from typings import Set
-from utils.database import PlyvelDict
-
-with open("config.json") as f:
-    config = json.load(f)
-
-token = config.get("NOTUS_TOKEN")
-prefixes = config.get("NOTUS_PREFIXES", [])
+from utils.broker import RemoteDB
+from utils.database import AsyncPlyvelDict, PlyvelDict, PlyvelSet
+from utils.http import HTTPClient
+from utils.permissions import PermissionCache
+from utils.prefixes import PrefixMatcher
+from utils.startup import Timings, preimport
+from utils.throttle import Throttler
+from utils.users import UserResolver
+from utils.watchdog import LoopWatchdog
+
+
+def command_prefix(notus: "Notus", message) -> list:
+    prefix = notus.prefixes.match(message)
+    return [prefix] if prefix else []
+
+
+class Notus(discord.Bot):
+    def __init__(self, config, timings: Timings = None, broker: str = None, **options):
+        super().__init__(command_prefix, **options)
+        self.timings = timings or Timings()
+        self.web = HTTPClient(
+            limit=config.get("NOTUS_HTTP_LIMIT", 100),
+            limit_per_host=config.get("NOTUS_HTTP_LIMIT_PER_HOST", 10),
+            timeout=config.get("NOTUS_HTTP_TIMEOUT", 30),
+        )
+        self.watchdog = LoopWatchdog(
+            threshold=config.get("NOTUS_WATCHDOG_THRESHOLD", 0.25)
+        )
+
+        with self.timings.phase("db open"):
+            path = config.get("NOTUS_DB_PATH", "./.notus_db")
+            storage = RemoteDB(broker) if broker else path
+            self.db = PlyvelDict(
+                storage,
+                cache_size=config.get("NOTUS_DB_CACHE_SIZE", 1024),
+                flat=config.get("NOTUS_DB_FLAT", False),
+                codec=config.get("NOTUS_DB_CODEC", "pickle"),
+            )
 
+            if broker:
+                storage.on_invalidate = self.db.invalidate
 
-class Notus(discord.Client):
-    def __init__(self, config, **options):
-        super().__init__(**options)
-        self.db = PlyvelDict("./.notus_db")
+        self.adb = AsyncPlyvelDict(self.db, config.get("NOTUS_DB_WORKERS", 4))
         self.config = config
         # self.send_command_help = send_cmd_help
 
+        if config.get("NOTUS_DB_GROUP_COMMIT"):
+            self.db.start_group_commit(config["NOTUS_DB_GROUP_COMMIT"])
+
+        if config.get("NOTUS_DB_SWEEP_INTERVAL", 1):
+            self.db.start_sweeper(config.get("NOTUS_DB_SWEEP_INTERVAL", 1))
+
         if "settings" not in self.db:
             self.db["settings"] = {}
 
-        if "blacklist" not in self.db["settings"]:
-            self.db["settings"]["blacklist"] = []
+        if "modules" not in self.db["settings"]:
+            self.db["settings"]["modules"] = []
+
+        self.prefixes = PrefixMatcher(self.db, config.get("NOTUS_PREFIXES", []))
+        self.blacklist = PlyvelSet(self.db, "blacklist")
+        self.user_resolver = UserResolver(self, self.adb)
+        self.permission_cache = PermissionCache()
+        self.permission_cache.attach(self)
+        self.throttler = Throttler(
+            config.get("NOTUS_THROTTLE_USER", (5, 10)),
+            config.get("NOTUS_THROTTLE_GUILD", (30, 10)),
+            config.get("NOTUS_THROTTLE_COMMANDS"),
+            config.get("NOTUS_THROTTLE_BLACKLIST_AFTER", 0),
+            self.blacklist_offender,
+        )
+
+        if "blacklist" in self.db["settings"]:
+            # Move over from the old layout of a single list inside settings.
+            with self.db.batch():
+                for user in self.db["settings"]["blacklist"]:
+                    self.blacklist.add(int(user))
+
+                del self.db["settings"]["blacklist"]
 
     async def close(self):
-        await self.session.close()
+        self.watchdog.stop()
+        await self.web.close()
         await super().close()
+        await self.adb.close()
+        self.db.close()
 
     @property
     def owners(self) -> Set[int]:
         """Get owners of the bot, regardless if it's in a team or not."""
         return self.owner_ids or set([self.owner_id])
 
-    async def on_ready(self):
-        self.session = aiohttp.ClientSession()
+    async def load_extensions(self):
+        """
+        Load the core and every saved module, after importing what they depend on
+        concurrently.
+        """
+        modules = ["modules.core", *self.db["settings"]["modules"]]
+
+        with self.timings.phase("imports"):
+            await preimport(modules)
+
+        with self.timings.phase("cog setup"):
+            for module in modules:
+                try:
+                    self.load_extension(module)
+                except Exception as e:
+                    print(f"Extension `{module}` blew up.")
+                    print("".join(traceback.format_tb(e.__traceback__)))
+
+                    if module in self.db["settings"]["modules"]:
+                        self.db["settings"]["modules"].remove(module)
+
+    async def start(self, token: str, *, reconnect: bool = True):
+        # Everything here runs once per process, unlike on_ready which also runs after
+        # every reconnect.
+        await self.web.start()
+
+        if self.config.get("NOTUS_WATCHDOG_THRESHOLD", 0.25):
+            self.watchdog.start()
+
+        await self.load_extensions()
+
+        with self.timings.phase("login"):
+            await self.login(token)
+            app = await self.application_info()
 
-        app = await self.application_info()
         self.invite_url = dutils.oauth_url(app.id)
 
         if app.team:
-            self.owner_ids = set(app.team.members)
+            self.owner_ids = {x.id for x in app.team.members}
         else:
             self.owner_id = app.owner.id
 
+        self._connecting = time.perf_counter()
+        await self.connect(reconnect=reconnect)
+
+    async def on_ready(self):
+        if "gateway ready" in self.timings.phases:
+            return
+
+        self.timings.record("gateway ready", time.perf_counter() - self._connecting)
+
         print("Ready.")
         print(self.invite_url)
         print(self.user.name)
         print("")
 
-        print(f"Owners: {', '.join(self.owners)}")
-
-        self.load_extension("modules.core")
+        print(f"Owners: {', '.join(map(str, self.owners))}")
+        print(self.timings.report())
 
     async def on_command_error(self, exception, context):
         # TODO: handle more exceptions
@@ -79,19 +179,52 @@ class Notus(discord.Client):
         elif isinstance(exception, discord.CommandNotFound):
             pass
 
+    def blacklist_offender(self, user_id: int):
+        if user_id not in self.owners and user_id not in self.blacklist:
+            print(f"Blacklisting {user_id} for repeatedly hitting command limits.")
+            self.blacklist.add(user_id)
+
     async def on_message(self, message):
-        if (
-            not message.content
-            or message.author.bot
-            or (
-                str(message.author.id) in self.db["settings"]["blacklist"]
-                and str(message.author.id) not in self.owners
-            )
+        # Most messages aren't commands, so rule those out before anything else.
+        prefix = not message.author.bot and self.prefixes.match(message)
+
+        if not prefix:
+            return
+
+        author = message.author.id
+
+        if author in self.owners:
+            return await self.process_commands(message)
+
+        name = message.content[len(prefix) :].split(None, 1)[:1]
+        command = self.all_commands.get(name[0]) if name else None
+
+        if author in self.blacklist or not self.throttler.allow(
+            author,
+            message.guild and message.guild.id,
+            command and command.qualified_name,
         ):
             return
 
-        self.process_commands(message)
+        await self.process_commands(message)
+
+
+if __name__ == "__main__":
+    timings = Timings()
+
+    with timings.phase("config"), open("config.json") as f:
+        config = json.load(f)
 
+    # Set by `utils.cluster` when running as one of several shard processes.
+    broker = os.environ.get("NOTUS_BROKER")
+    shard_options = {
+        option: int(os.environ[name])
+        for option, name in [
+            ("shard_id", "NOTUS_SHARD_ID"),
+            ("shard_count", "NOTUS_SHARD_COUNT"),
+        ]
+        if name in os.environ
+    }
 
-notus = Notus(config)
-notus.run(token)
+    notus = Notus(config, timings, broker, **shard_options)
+    notus.run(config.get("NOTUS_TOKEN"))
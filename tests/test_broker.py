@@ -0,0 +1,132 @@
+import asyncio
+import threading
+
+import pytest
+
+from utils.broker import Broker, RemoteDB
+from utils.database import PlyvelDict, WriteConflict
+
+
+@pytest.fixture
+def broker(tmp_path):
+    broker = Broker(str(tmp_path / "db"), str(tmp_path / "db.sock"))
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    async def start():
+        return await asyncio.start_unix_server(broker._serve, broker.socket_path)
+
+    server = asyncio.run_coroutine_threadsafe(start(), loop).result()
+    yield broker
+
+    async def stop():
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run_coroutine_threadsafe(stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+    broker.close()
+
+
+@pytest.fixture
+def connect(broker):
+    """Open `PlyvelDict`s on the broker, as separate shard processes would."""
+    clients = []
+
+    def connect(**options) -> PlyvelDict:
+        remote = RemoteDB(broker.socket_path)
+        db = PlyvelDict(remote, cache_size=100, **options)
+        remote.on_invalidate = db.invalidate
+        clients.append(db)
+        return db
+
+    yield connect
+
+    for db in clients:
+        db.close()
+        db._db.close()
+
+
+def in_threads(*funcs):
+    threads = [threading.Thread(target=func) for func in funcs]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_reads_see_other_clients_writes(connect):
+    a, b = connect(), connect()
+    a["k"] = 1
+    assert b["k"] == 1
+
+    a["k"] = 2
+    b["other"] = 1  # Notices come before replies, so b has heard about it now
+    assert b["k"] == 2
+    assert len(a) == len(b) == 2
+
+
+@pytest.mark.parametrize("flat", [False, True], ids=["plain", "flat"])
+def test_list_appends_from_two_clients(connect, flat):
+    a, b = connect(flat=flat), connect(flat=flat)
+    a["settings"] = {"modules": []}
+
+    def append(db, offset):
+        def run():
+            for i in range(100):
+                db["settings"]["modules"].append(offset + i)
+
+        return run
+
+    in_threads(append(a, 0), append(b, 1000))
+
+    modules = a["settings"]["modules"].to_original()
+    assert sorted(modules) == [*range(100), *range(1000, 1100)]
+
+
+def test_stale_proxy_keeps_other_clients_changes(connect):
+    a, b = connect(), connect()
+    a["settings"] = {"x": 0}
+    stale = a["settings"]
+    b["settings"]["y"] = 1
+
+    stale["z"] = 2
+    assert a["settings"].to_original() == {"x": 0, "y": 1, "z": 2}
+
+
+def test_modify_counts_every_increment(connect):
+    a, b = connect(), connect()
+    a["eval"] = {"env": {}, "count": 0}
+
+    def increment(db):
+        def add(value):
+            value["count"] += 1
+            return value
+
+        def run():
+            for _ in range(100):
+                db.modify("eval", add)
+
+        return run
+
+    in_threads(increment(a), increment(b))
+    assert a["eval"]["count"] == b["eval"]["count"] == 200
+
+
+def test_guarded_batch_fails_as_a_whole(connect):
+    a, b = connect(), connect()
+    a["k"] = 1
+    raw = a._get_raw(b"k")
+    b["k"] = 2
+
+    with pytest.raises(WriteConflict):
+        with a.batch():
+            a["other"] = 1
+            a._guard(b"k", raw)
+
+    assert "other" not in b and "other" not in a
+    assert len(b) == 1
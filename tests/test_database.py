@@ -0,0 +1,386 @@
+import gc
+import sys
+import threading
+
+import plyvel
+import pytest
+
+from utils.database import SEP, PlyvelDict
+
+
+@pytest.fixture(params=[False, True], ids=["plain", "flat"])
+def db(request, tmp_path):
+    db = PlyvelDict(str(tmp_path / "db"), flat=request.param)
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def flat_db(tmp_path):
+    db = PlyvelDict(str(tmp_path / "db"), flat=True)
+    yield db
+    db.close()
+
+
+def stored_keys(db: PlyvelDict, prefix: bytes) -> set:
+    db.flush()
+    return set(db._db.iterator(prefix=prefix, include_value=False))
+
+
+def test_nested_write_through_new_child(db):
+    db["settings"] = {}
+    settings = db["settings"]
+    settings["new"] = {"k": [1]}
+    settings["new"]["k"].append(3)
+
+    assert db["settings"].to_original() == {"new": {"k": [1, 3]}}
+
+
+def test_nested_write_in_list(db):
+    db["root"] = {"items": [{"n": 1}]}
+    db["root"]["items"][0]["n"] = 2
+
+    assert db["root"].to_original() == {"items": [{"n": 2}]}
+
+
+def test_values_survive_reopening(db, tmp_path):
+    value = {"a": {"b": [1, {"c": 2}]}, "d": 3, 4: {"e": 5}}
+    db["root"] = value
+    db.close()
+
+    reopened = PlyvelDict(str(tmp_path / "db"), flat=db._flat)
+
+    try:
+        assert reopened["root"].to_original() == value
+    finally:
+        reopened.close()
+
+
+def test_failing_to_open_raises_only_that(tmp_path, monkeypatch):
+    unraisable = []
+    monkeypatch.setattr(sys, "unraisablehook", unraisable.append)
+    db = PlyvelDict(str(tmp_path / "db"))
+
+    try:
+        with pytest.raises(plyvel.IOError):  # Locked by `db`
+            PlyvelDict(str(tmp_path / "db"))
+
+        gc.collect()
+        assert unraisable == []
+    finally:
+        db.close()
+
+
+def test_flat_children_get_their_own_keys(flat_db):
+    flat_db["root"] = {"a": {"b": [1]}, "c": 1, 2: {"d": 1}}
+
+    # Only containers under string keys are moved out.
+    assert stored_keys(flat_db, b"root" + SEP) == {
+        b"root" + SEP + b"a",
+        b"root" + SEP + b"a" + SEP + b"b",
+    }
+
+
+def test_flat_replacing_child_removes_its_keys(flat_db):
+    flat_db["root"] = {"a": {"b": [1], "c": {"d": 1}}}
+    flat_db["root"]["a"] = 1
+
+    assert stored_keys(flat_db, b"root" + SEP) == set()
+    assert flat_db["root"].to_original() == {"a": 1}
+
+
+def test_flat_replacing_grandchild_keeps_siblings(flat_db):
+    flat_db["root"] = {"a": {"b": [1], "c": [2]}}
+    flat_db["root"]["a"]["b"] = None
+
+    assert stored_keys(flat_db, b"root" + SEP) == {
+        b"root" + SEP + b"a",
+        b"root" + SEP + b"a" + SEP + b"c",
+    }
+    assert flat_db["root"].to_original() == {"a": {"b": None, "c": [2]}}
+
+
+def test_flat_deleting_child_removes_its_keys(flat_db):
+    flat_db["root"] = {"a": {"b": [1]}, "c": [2]}
+    del flat_db["root"]["a"]
+
+    assert stored_keys(flat_db, b"root" + SEP) == {b"root" + SEP + b"c"}
+    assert flat_db["root"].to_original() == {"c": [2]}
+
+
+def test_flat_popping_child_returns_its_data(flat_db):
+    flat_db["root"] = {"a": {"b": [1]}}
+
+    assert flat_db["root"].pop("a") == {"b": [1]}
+    assert stored_keys(flat_db, b"root" + SEP) == set()
+    assert flat_db["root"].to_original() == {}
+
+
+def test_flat_deleting_root_removes_children(flat_db):
+    flat_db["root"] = {"a": {"b": [1]}}
+    flat_db["rooted"] = {"a": [1]}
+    del flat_db["root"]
+
+    assert "root" not in flat_db
+    assert stored_keys(flat_db, b"root" + SEP) == set()
+    assert flat_db["rooted"].to_original() == {"a": [1]}
+    assert len(flat_db) == 1
+
+
+def test_flat_reads_plain_databases(tmp_path):
+    plain = PlyvelDict(str(tmp_path / "db"))
+    plain["root"] = {"a": {"b": [1]}}
+    plain.close()
+
+    db = PlyvelDict(str(tmp_path / "db"), flat=True)
+
+    try:
+        db["root"]["a"]["b"].append(2)
+        assert db["root"].to_original() == {"a": {"b": [1, 2]}}
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def cached_db(tmp_path):
+    db = PlyvelDict(str(tmp_path / "db"), cache_size=100)
+    yield db
+    db.close()
+
+
+def test_batch_commits_atomically(cached_db):
+    with cached_db.batch():
+        cached_db["a"] = 1
+        cached_db["b"] = 2
+        assert cached_db._db.get(b"a") is None  # Not committed yet
+        assert cached_db["a"] == 1
+
+    assert cached_db._db.get(b"a") is not None
+    assert (cached_db["a"], cached_db["b"]) == (1, 2)
+
+
+def test_batch_rolls_back_on_exception(cached_db):
+    cached_db["a"] = 1
+    cached_db["gone"] = 1
+
+    with pytest.raises(ValueError):
+        with cached_db.batch():
+            cached_db["a"] = 2
+            cached_db["b"] = 2
+            del cached_db["gone"]
+
+            with cached_db.batch():  # Nested batches join the outer one
+                cached_db["c"] = 3
+
+            raise ValueError
+
+    assert cached_db["a"] == 1
+    assert cached_db["gone"] == 1
+    assert "b" not in cached_db and "c" not in cached_db
+    assert not cached_db._pending
+
+    cached_db.cache_clear()
+    assert cached_db["a"] == 1 and "b" not in cached_db
+
+
+def test_counts_after_rollback(cached_db):
+    cached_db["user:1"] = 1
+    cached_db["guild:1"] = 1
+
+    with pytest.raises(ValueError):
+        with cached_db.batch():
+            cached_db["user:2"] = 1
+            del cached_db["guild:1"]
+            raise ValueError
+
+    assert len(cached_db) == 2
+    assert {ns: x["keys"] for ns, x in cached_db.stats()["namespaces"].items()} == {
+        "user": 1,
+        "guild": 1,
+    }
+
+
+def test_counts_persist(tmp_path):
+    db = PlyvelDict(str(tmp_path / "db"))
+    db["user:1"] = 1
+    db["user:2"] = 1
+    db["user:2"] = 2  # Overwriting doesn't count twice
+    db["guild:1"] = 1
+    del db["guild:1"]
+    del db["guild:2"]  # Nor does deleting something missing
+    db.close()
+
+    db = PlyvelDict(str(tmp_path / "db"))
+
+    try:
+        assert len(db) == 2
+        assert db.stats()["namespaces"].keys() == {"user"}
+
+        db.recount()
+        assert len(db) == 2
+    finally:
+        db.close()
+
+
+def test_group_commit(cached_db):
+    cached_db.start_group_commit(interval=60, max_pending=5)
+    cached_db["a"] = 1
+
+    assert cached_db._db.get(b"a") is None
+    assert cached_db["a"] == 1 and len(cached_db) == 1
+
+    cached_db["b"] = 2  # With both namespaces and the total count, 5 keys wait
+    assert cached_db._db.get(b"a") is not None
+
+    cached_db["c"] = 3
+    cached_db.stop_group_commit()
+    assert cached_db._db.get(b"c") is not None
+
+
+def test_group_commit_rolls_back_only_the_batch(cached_db):
+    cached_db.start_group_commit(interval=60)
+    cached_db["a"] = 1
+
+    with pytest.raises(ValueError):
+        with cached_db.batch():
+            cached_db["a"] = 2
+            cached_db["b"] = 2
+            raise ValueError
+
+    cached_db.stop_group_commit()
+    assert cached_db._db.get(b"b") is None
+    assert cached_db["a"] == 1 and len(cached_db) == 1
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000]
+    monkeypatch.setattr("utils.database._now", lambda: now[0])
+    return now
+
+
+def test_expired_keys_read_as_missing(cached_db, clock):
+    cached_db.set("a", 1, ttl=10)
+    cached_db["b"] = 1
+    assert cached_db.ttl("a") == 10 and cached_db.ttl("b") is None
+
+    clock[0] += 10_000
+
+    assert "a" not in cached_db
+    with pytest.raises(KeyError):
+        cached_db["a"]
+    assert list(cached_db.keys()) == ["b"]
+    assert len(cached_db) == 2  # Until swept
+
+
+def test_sweep_deletes_expired_keys(cached_db, clock):
+    cached_db.set("a", 1, ttl=10)
+    cached_db.set("b", 1, ttl=20)
+    cached_db.set("c", 1, ttl=10)
+    cached_db.set("c", 2)  # No longer expires
+
+    clock[0] += 15_000
+
+    assert cached_db.sweep() == 1
+    assert cached_db._db.get(b"a") is None
+    assert cached_db["b"] == 1 and cached_db["c"] == 2
+    assert len(cached_db) == 2
+
+    clock[0] += 10_000
+    cached_db.sweep()
+    assert len(cached_db) == 1
+    assert stored_keys(cached_db, b"\x00expire:") == set()
+
+
+def test_sweep_persists_across_reopening(tmp_path, clock):
+    db = PlyvelDict(str(tmp_path / "db"))
+    db.set("a", 1, ttl=10)
+    db.close()
+
+    clock[0] += 10_000
+    db = PlyvelDict(str(tmp_path / "db"))
+
+    try:
+        assert "a" not in db
+        db.sweep()
+        assert len(db) == 0 and db._db.get(b"a") is None
+    finally:
+        db.close()
+
+
+def pause_reads(db: PlyvelDict):
+    """
+    Make reads from other threads stop after reading and before caching, until the
+    returned event is set. Returns `(reading, resume)` events.
+    """
+    reading, resume = threading.Event(), threading.Event()
+    decode = db._decode
+    main = threading.current_thread()
+
+    def paused(key, raw):
+        if threading.current_thread() is not main:
+            reading.set()
+            resume.wait()
+
+        return decode(key, raw)
+
+    db._decode = paused
+    return reading, resume
+
+
+def test_cache_keeps_writes_made_during_reads(cached_db):
+    cached_db["a"] = 1
+    cached_db.cache_clear()
+    reading, resume = pause_reads(cached_db)
+    reader = threading.Thread(target=cached_db.__getitem__, args=("a",))
+    reader.start()
+
+    reading.wait()
+    cached_db["a"] = 2
+    resume.set()
+    reader.join()
+
+    assert cached_db["a"] == 2
+
+
+def test_cache_keeps_invalidations_made_during_reads(cached_db):
+    cached_db["a"] = 1
+    cached_db.cache_clear()
+    reading, resume = pause_reads(cached_db)
+    reader = threading.Thread(target=cached_db.__getitem__, args=("a",))
+    reader.start()
+
+    # As if another process wrote it and the broker told us.
+    reading.wait()
+    cached_db._db.put(b"a", cached_db._encode(b"a", 2))
+    cached_db.invalidate({b"a": True})
+    resume.set()
+    reader.join()
+
+    assert cached_db["a"] == 2
+
+
+def test_stale_proxies_keep_each_others_changes(db):
+    db["root"] = {"items": []}
+    a, b = db["root"], db["root"]
+    items = db["root"]["items"]
+
+    a["x"] = 1
+    b["y"] = 2
+    items.append(3)
+    assert items.pop() == 3
+    items.append(4)
+
+    assert db["root"].to_original() == {"items": [4], "x": 1, "y": 2}
+
+
+def test_modify(cached_db, clock):
+    cached_db.set("a", {"n": 1}, ttl=10)
+
+    assert cached_db.modify("a", lambda x: {"n": x["n"] + 1}) == {"n": 2}
+    assert cached_db["a"]["n"] == 2 and cached_db.ttl("a") == 10
+    assert cached_db.modify("b", lambda x: x + 1, 0) == 1
+    assert len(cached_db) == 2
+
+    with pytest.raises(KeyError):
+        cached_db.modify("c", lambda x: x)
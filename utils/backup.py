@@ -0,0 +1,180 @@
+"""
+Back up and restore a Notus database.
+
+    python -m utils.backup create [--db ./.notus_db | --broker SOCKET] [-o FILE]
+    python -m utils.backup restore FILE [--db ./.notus_db | --broker SOCKET]
+    python -m utils.backup verify FILE
+
+A backup is a gzip stream of the encoded keys and values as of one snapshot, each
+record prefixed with their lengths, followed by an end marker and a SHA-256 digest of
+all records. Values are copied as stored, so no decoding is involved either way.
+
+LevelDB lets only one process open a database, so `--db` needs the bot stopped. While
+it runs, use the backup command in Discord, or `--broker` for a cluster.
+"""
+
+import argparse
+import gzip
+import hashlib
+import os
+import struct
+import time
+import zlib
+from typing import BinaryIO, Iterator, Tuple
+
+import plyvel
+
+from utils.broker import RemoteDB
+from utils.database import PlyvelDict
+
+MAGIC = b"NOTUSDB\x01"
+RECORD = struct.Struct("!II")
+END = RECORD.pack(0xFFFFFFFF, 0)
+BUFFER_SIZE = 1024 * 1024
+
+
+class BackupError(Exception):
+    pass
+
+
+def dump(reader, fileobj: BinaryIO, level: int = 6) -> int:
+    """Write all keys of a plyvel database or snapshot to a file, returning how many."""
+    digest = hashlib.sha256()
+    buffer = bytearray()
+    count = 0
+
+    with gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=level, mtime=0) as f:
+        f.write(MAGIC)
+
+        for key, value in reader.iterator():
+            record = RECORD.pack(len(key), len(value)) + key + value
+            digest.update(record)
+            buffer += record
+            count += 1
+
+            if len(buffer) >= BUFFER_SIZE:
+                f.write(buffer)
+                buffer.clear()
+
+        f.write(buffer + END + digest.digest())
+
+    return count
+
+
+def load(fileobj: BinaryIO) -> Iterator[Tuple[bytes, bytes]]:
+    """
+    Yield the `(key, value)` pairs of a backup, raising BackupError at the end if it's
+    truncated or doesn't match its digest. Use `verify` first to avoid acting on any.
+    """
+    digest = hashlib.sha256()
+
+    try:
+        with gzip.GzipFile(fileobj=fileobj, mode="rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise BackupError("Not a Notus database backup")
+
+            while True:
+                header = f.read(RECORD.size)
+
+                if header == END:
+                    break
+                if len(header) < RECORD.size:
+                    raise BackupError("Backup is truncated")
+
+                key_size, value_size = RECORD.unpack(header)
+                key = f.read(key_size)
+                value = f.read(value_size)
+
+                if len(key) + len(value) < key_size + value_size:
+                    raise BackupError("Backup is truncated")
+
+                digest.update(header + key + value)
+                yield key, value
+
+            if f.read(digest.digest_size) != digest.digest():
+                raise BackupError("Backup is corrupt, its checksum doesn't match")
+    except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+        raise BackupError(f"Backup is corrupt: {e}") from None
+
+
+def verify(path: str) -> int:
+    """Check a backup file, returning the number of keys in it."""
+    with open(path, "rb") as f:
+        return sum(1 for _ in load(f))
+
+
+def backup(db: PlyvelDict, path: str, level: int = 6) -> dict:
+    """
+    Write a consistent backup of `db` to `path`. Writes carry on meanwhile, as only a
+    snapshot is read. Blocking, so run it on a thread from async code.
+    """
+    start = time.perf_counter()
+    tmp = f"{path}.tmp"
+
+    with db.raw_snapshot() as snapshot, open(tmp, "wb") as f:
+        keys = dump(snapshot, f, level)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp, path)  # Never leave a partial backup under the real name
+    return {
+        "keys": keys,
+        "bytes": os.path.getsize(path),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def restore(db: PlyvelDict, path: str) -> dict:
+    """
+    Replace the contents of `db` with a backup, after checking all of it. Blocking, and
+    holds up other writes to `db` while loading.
+    """
+    start = time.perf_counter()
+    keys = verify(path)
+
+    with open(path, "rb") as f:
+        db.replace_raw(load(f))
+
+    return {"keys": keys, "seconds": time.perf_counter() - start}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("action", choices=["create", "restore", "verify"])
+    parser.add_argument("file", nargs="?")
+    parser.add_argument("--db", default="./.notus_db")
+    parser.add_argument("--broker", help="go through a running cluster's broker")
+    parser.add_argument("-o", "--output", help="backup file to create")
+    args = parser.parse_args()
+
+    if args.action != "create" and not args.file:
+        parser.error(f"{args.action} needs a backup file")
+
+    if args.action == "verify":
+        return print(f"OK, {verify(args.file)} keys.")
+
+    try:
+        db = PlyvelDict(RemoteDB(args.broker) if args.broker else args.db)
+    except plyvel.IOError as e:
+        if b"lock" not in e.args[0]:
+            raise
+
+        parser.error(
+            f"{args.db} is in use, probably by the bot. Stop it first, or use the "
+            "backup command in Discord, or --broker when running a cluster."
+        )
+
+    try:
+        if args.action == "create":
+            path = args.output or time.strftime("notus-%Y%m%d-%H%M%S.ndb.gz")
+            stats = backup(db, path)
+            print(f"Backed up {stats['keys']} keys to {path} ({stats['bytes']} bytes).")
+        else:
+            stats = restore(db, args.file)
+            print(f"Restored {stats['keys']} keys in {stats['seconds']:.2f}s.")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,491 @@
+"""
+Share one LevelDB between processes. LevelDB only allows a single process to open a
+database, so a broker process owns it and serves reads and writes over a Unix socket:
+
+    python -m utils.broker [--db ./.notus_db] [--socket ./.notus_db.sock]
+
+Clients use `RemoteDB` in place of `plyvel.DB`, e.g. `PlyvelDict(RemoteDB(path))`.
+Writes from a `PlyvelDict` batch travel as one message and are applied atomically.
+Each client caches values it read, and the broker tells every other client which keys
+a write changed so they can drop them. Writes can carry digests of the values they were
+based on, and are refused if another client changed those first.
+
+Messages are length-prefixed and encoded with marshal, which can't run code on load.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import itertools
+import marshal
+import os
+import signal
+import socket
+import struct
+import threading
+from typing import Optional
+
+import plyvel
+
+from utils.database import COUNT_KEY, LRUCache, PlyvelDict, WriteConflict
+
+HEADER = struct.Struct("!I")
+CHUNK_SIZE = 1000  # Keys fetched per round trip while iterating
+
+_missing = object()
+
+
+class BrokerError(Exception):
+    pass
+
+
+def _frame(message) -> bytes:
+    data = marshal.dumps(message)
+    return HEADER.pack(len(data)) + data
+
+
+def _digest(raw: Optional[bytes]) -> Optional[bytes]:
+    return None if raw is None else hashlib.blake2b(raw, digest_size=16).digest()
+
+
+def _upper_bound(prefix: bytes) -> Optional[bytes]:
+    """Smallest key greater than every key starting with `prefix`, or None."""
+    prefix = prefix.rstrip(b"\xff")
+    return prefix[:-1] + bytes([prefix[-1] + 1]) if prefix else None
+
+
+class Broker:
+    """Serve a LevelDB at `path` to `RemoteDB` clients connecting to `socket_path`."""
+
+    def __init__(self, path: str, socket_path: str):
+        self.db = plyvel.DB(path, create_if_missing=True)
+        self.store = PlyvelDict(self.db)  # Keeps key counts right across clients
+        self.socket_path = socket_path
+        self._clients = set()
+        self._snapshots = {}  # id -> (client, snapshot)
+        self._ids = itertools.count(1)
+
+    def _reader(self, snapshot: Optional[int]):
+        return self.db if snapshot is None else self._snapshots[snapshot][1]
+
+    def get(self, client, key: bytes, snapshot: int = None):
+        return self._reader(snapshot).get(key)
+
+    def iterate(
+        self,
+        client,
+        start,
+        stop,
+        include_start,
+        include_stop,
+        reverse,
+        include_value,
+        snapshot=None,
+    ):
+        iterator = self._reader(snapshot).iterator(
+            start=start,
+            stop=stop,
+            include_start=include_start,
+            include_stop=include_stop,
+            reverse=reverse,
+            include_value=include_value,
+        )
+
+        with iterator:
+            return list(itertools.islice(iterator, CHUNK_SIZE))
+
+    def write(self, client, changes: list, expected: dict = None):
+        """
+        Apply changes unless a key in `expected` no longer has the value of that
+        digest. Returns the counts written, and the keys which did change.
+        """
+        conflicts = [
+            key
+            for key, digest in (expected or {}).items()
+            if _digest(self.db.get(key)) != digest
+        ]
+
+        if conflicts:
+            return None, conflicts
+
+        written = self.store.apply_raw(changes)
+        exists = {key: raw is not None for key, raw in written.items()}
+        message = _frame((0, True, exists))
+
+        for other in self._clients:
+            if other is not client:
+                other.write(message)
+
+        # The writer knows what it wrote, but only the broker knows the real counts.
+        return {k: v for k, v in written.items() if k.startswith(COUNT_KEY)}, []
+
+    def snapshot(self, client) -> int:
+        id_ = next(self._ids)
+        self._snapshots[id_] = (client, self.db.snapshot())
+        return id_
+
+    def release(self, client, snapshot: int):
+        _, snap = self._snapshots.pop(snapshot, (None, None))
+
+        if snap is not None:
+            snap.close()
+
+    def approximate_sizes(self, client, ranges: list):
+        return self.db.approximate_sizes(*ranges)
+
+    def compact_range(self, client, start, stop):
+        self.db.compact_range(start=start, stop=stop)
+
+    OPERATIONS = {
+        "get",
+        "iterate",
+        "write",
+        "snapshot",
+        "release",
+        "approximate_sizes",
+        "compact_range",
+    }
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._clients.add(writer)
+
+        try:
+            while True:
+                header = await reader.readexactly(HEADER.size)
+                id_, op, args = marshal.loads(
+                    await reader.readexactly(HEADER.unpack(header)[0])
+                )
+
+                try:
+                    if op not in self.OPERATIONS:
+                        raise BrokerError(f"Unknown operation {op!r}")
+
+                    reply = (id_, True, getattr(self, op)(writer, *args))
+                except Exception as e:
+                    reply = (id_, False, f"{type(e).__name__}: {e}")
+
+                writer.write(_frame(reply))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            pass  # The broker is shutting down
+        finally:
+            self._clients.discard(writer)
+
+            for id_, (client, _) in list(self._snapshots.items()):
+                if client is writer:
+                    self.release(writer, id_)
+
+            writer.close()
+
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)  # Left over from a broker that didn't exit
+
+        server = await asyncio.start_unix_server(self._serve, self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+
+        loop = asyncio.get_event_loop()
+        stop = asyncio.Event()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        async with server:
+            await stop.wait()
+
+        os.unlink(self.socket_path)
+
+    def close(self):
+        for _, snap in self._snapshots.values():
+            snap.close()
+
+        self.store.close()
+
+
+class _Waiter:
+    __slots__ = ("event", "ok", "result", "on_reply")
+
+    def __init__(self, on_reply):
+        self.event = threading.Event()
+        self.on_reply = on_reply
+
+    def set(self, ok: bool, result):
+        self.ok = ok
+        self.result = result
+        self.event.set()
+
+
+class _RemoteWriteBatch:
+    def __init__(self, db: "RemoteDB"):
+        self._db = db
+        self._changes = []
+        self._expected = {}
+
+    def expect(self, key: bytes, value: Optional[bytes]):
+        """Only apply the batch if `key` still has `value` (None for missing)."""
+        self._expected[key] = _digest(value)
+
+    def put(self, key: bytes, value: bytes):
+        self._changes.append((key, value))
+
+    def delete(self, key: bytes):
+        self._changes.append((key, None))
+
+    def clear(self):
+        self._changes.clear()
+        self._expected.clear()
+
+    def write(self):
+        if self._changes:
+            self._db._write(self._changes, self._expected)
+            self._changes = []
+            self._expected = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.write()
+
+
+class _RemoteReader:
+    def __init__(self, db: "RemoteDB", snapshot: Optional[int]):
+        self._db = db
+        self._snapshot = snapshot
+
+    def get(self, key: bytes, default=None):
+        value = self._db._call("get", key, self._snapshot)
+        return default if value is None else value
+
+    def iterator(
+        self,
+        reverse=False,
+        start=None,
+        stop=None,
+        include_start=True,
+        include_stop=False,
+        prefix=None,
+        include_key=True,
+        include_value=True,
+    ):
+        if prefix is not None:
+            start, stop = prefix, _upper_bound(prefix)
+
+        while True:
+            chunk = self._db._call(
+                "iterate",
+                start,
+                stop,
+                include_start,
+                include_stop,
+                reverse,
+                include_value,
+                self._snapshot,
+            )
+
+            for entry in chunk:
+                yield entry if include_key or not include_value else entry[1]
+
+            if len(chunk) < CHUNK_SIZE:
+                return
+
+            last = chunk[-1][0] if include_value else chunk[-1]
+
+            if reverse:
+                stop, include_stop = last, False
+            else:
+                start, include_start = last, False
+
+
+class _RemoteSnapshot(_RemoteReader):
+    def close(self):
+        self._db._call("release", self._snapshot)
+
+
+class RemoteDB(_RemoteReader):
+    """
+    Client of a `Broker`, implementing the parts of `plyvel.DB` that `PlyvelDict` uses.
+    Values read are cached, up to `cache_size` entries and `cache_bytes` bytes. Wire up
+    `on_invalidate` (e.g. to `PlyvelDict.invalidate`) to hear about keys other clients
+    changed. Thread-safe.
+    """
+
+    shared = True  # Other processes write too, see `PlyvelDict._guard`
+
+    def __init__(
+        self, path: str, cache_size: int = 10000, cache_bytes: int = 64 * 1024 * 1024
+    ):
+        super().__init__(self, None)
+        self.name = path
+        self.closed = False
+        self.on_invalidate = None
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(path)
+        self._file = self._socket.makefile("rb")
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._waiters = {}
+        self._cache = LRUCache(cache_size, cache_bytes)
+
+        threading.Thread(
+            target=self._receive, name="RemoteDB receiver", daemon=True
+        ).start()
+
+    def _call(self, op: str, *args, on_reply=None):
+        waiter = _Waiter(on_reply)
+
+        with self._lock:
+            if self.closed:
+                raise BrokerError("Connection to the broker is closed")
+
+            id_ = next(self._ids)
+            self._waiters[id_] = waiter
+            self._socket.sendall(_frame((id_, op, args)))
+
+        waiter.event.wait()
+
+        if not waiter.ok:
+            raise BrokerError(waiter.result)
+
+        return waiter.result
+
+    def _receive(self):
+        """
+        Read replies and change notices in the order the broker sent them. Replies
+        update the cache from this thread too, so a value read just before another
+        client changed it can't be cached after the notice about the change.
+        """
+        try:
+            while True:
+                header = self._file.read(HEADER.size)
+
+                if len(header) < HEADER.size:
+                    break
+
+                id_, ok, result = marshal.loads(
+                    self._file.read(HEADER.unpack(header)[0])
+                )
+
+                if id_ == 0:
+                    self._invalidated(result)
+                    continue
+
+                waiter = self._waiters.pop(id_)
+
+                if ok and waiter.on_reply is not None:
+                    waiter.on_reply(result)
+
+                waiter.set(ok, result)
+        except (OSError, ValueError):
+            pass
+
+        with self._lock:
+            self.closed = True
+
+            for waiter in self._waiters.values():
+                waiter.set(False, "Lost connection to the broker")
+
+            self._waiters.clear()
+
+    def _invalidated(self, changes: dict):
+        for key in changes:
+            self._cache.pop(key)
+
+        if self.on_invalidate is not None:
+            self.on_invalidate(changes)
+
+    def _write(self, changes: list, expected: dict = None):
+        def on_reply(result):
+            counts, conflicts = result
+
+            for key in conflicts:
+                self._cache.pop(key)
+
+            if conflicts:
+                return
+
+            for key, raw in itertools.chain(changes, counts.items()):
+                self._cache.put(key, raw, len(raw) if raw else 0)
+
+            if self.on_invalidate is not None:
+                self.on_invalidate(dict.fromkeys(counts, True))
+
+        _, conflicts = self._call("write", changes, expected, on_reply=on_reply)
+
+        if conflicts:
+            raise WriteConflict(conflicts)
+
+    def get(self, key: bytes, default=None):
+        value = self._cache.get(key, _missing)
+
+        if value is _missing:
+
+            def on_reply(raw):
+                self._cache.put(key, raw, len(raw) if raw else 0)
+
+            value = self._call("get", key, None, on_reply=on_reply)
+
+        return default if value is None else value
+
+    def put(self, key: bytes, value: bytes):
+        self._write([(key, value)])
+
+    def delete(self, key: bytes):
+        self._write([(key, None)])
+
+    def write_batch(self, transaction: bool = False):
+        # Batches are always applied atomically by the broker.
+        return _RemoteWriteBatch(self)
+
+    def snapshot(self):
+        return _RemoteSnapshot(self, self._call("snapshot"))
+
+    def approximate_size(self, start: bytes, stop: bytes) -> int:
+        return self.approximate_sizes((start, stop))[0]
+
+    def approximate_sizes(self, *ranges):
+        return self._call("approximate_sizes", list(ranges))
+
+    def compact_range(self, start=None, stop=None):
+        self._call("compact_range", start, stop)
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+
+            self.closed = True
+
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # The broker went away first
+
+        self._socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Share a LevelDB between processes.")
+    parser.add_argument("--db", default="./.notus_db")
+    parser.add_argument("--socket", default="./.notus_db.sock")
+    args = parser.parse_args()
+
+    broker = Broker(args.db, args.socket)
+
+    try:
+        asyncio.run(broker.serve_forever())
+    finally:
+        broker.close()
+
+
+if __name__ == "__main__":
+    main()
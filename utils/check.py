@@ -15,29 +15,46 @@ def guild():
     """Check if called in a guild"""
 
     def checker(ctx: Context):
-        return not ctx.is_dm()
+        return ctx.guild is not None
 
     return check(checker)
 
 
 def roles(*roles: int):
     """Check if caller has all given roles"""
+    required = frozenset(roles)
 
     def checker(ctx: Context):
-        return not ctx.is_dm() and all([x.id in roles for x in ctx.author.roles])
+        if ctx.guild is None:
+            return False
+
+        # @everyone's id is the guild's, and it's in `roles` too.
+        return required.issubset(x.id for x in ctx.author.roles)
 
     return check(checker)
 
 
 def named_roles(*roles: str):
     """Check if caller has all given roles, checking by name"""
+    required = frozenset(roles)
 
     def checker(ctx: Context):
-        return not ctx.is_dm() and all([x.name in roles for x in ctx.author.roles])
+        return ctx.guild is not None and required.issubset(
+            x.name for x in ctx.author.roles
+        )
 
     return check(checker)
 
 
+def _permissions_for(ctx: Context, member: discord.Member) -> discord.Permissions:
+    cache = getattr(ctx.bot, "permission_cache", None)
+
+    if cache is None:
+        return ctx.channel.permissions_for(member)
+
+    return cache.get(member, ctx.channel)
+
+
 def nsfw():
     """Check if called in a NSFW channel"""
 
@@ -55,7 +72,7 @@ class permissions:
         def checker(ctx: Context):
             return (
                 isinstance(ctx.author, discord.Member)
-                and ctx.author.permissions_in(ctx.channel) >= permissions
+                and _permissions_for(ctx, ctx.author) >= permissions
             )
 
         return check(checker)
@@ -67,7 +84,7 @@ class permissions:
         def checker(ctx: Context):
             return (
                 isinstance(ctx.me, discord.Member)
-                and ctx.me.permissions_in(ctx.channel) >= permissions
+                and _permissions_for(ctx, ctx.me) >= permissions
             )
 
         return check(checker)
@@ -0,0 +1,80 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Callable, Optional, Tuple
+
+import discord
+
+# Bulk delete refuses messages older than 14 days, keep a minute of headroom.
+BULK_MAX_AGE = timedelta(days=14, minutes=-1)
+BULK_MAX = 100
+
+
+def bulk_cutoff() -> int:
+    """Oldest message id bulk delete still accepts."""
+    return discord.utils.time_snowflake(datetime.utcnow() - BULK_MAX_AGE)
+
+
+async def purge(
+    channel: discord.TextChannel,
+    check: Callable[[discord.Message], bool],
+    limit: Optional[int] = 100,
+    bulk: bool = True,
+    concurrency: int = 5,
+) -> Tuple[int, int]:
+    """
+    Delete messages matching `check` among the last `limit` (or all, if None) messages
+    of a channel, returning how many were bulk and singly deleted.
+
+    Recent messages are bulk deleted in chunks of 100 while history is still being
+    paged through. Older ones, or all of them with `bulk=False` (e.g. without
+    manage_messages), are deleted one by one with up to `concurrency` in flight. No
+    sleeps are needed: discord.py holds each request back until its rate limit bucket,
+    as reported by Discord's headers, has room again.
+    """
+    cutoff = bulk_cutoff() if bulk else None
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = []
+    chunk = []
+    counts = [0, 0]
+
+    async def delete_bulk(messages):
+        await channel.delete_messages(messages)
+        counts[0] += len(messages)
+
+    async def delete_single(message):
+        async with semaphore:
+            try:
+                await message.delete()
+            except discord.NotFound:
+                return
+
+        counts[1] += 1
+
+    async for message in channel.history(limit=limit):
+        if not check(message):
+            continue
+
+        if bulk and message.id > cutoff:
+            chunk.append(message)
+
+            if len(chunk) == BULK_MAX:
+                tasks.append(asyncio.ensure_future(delete_bulk(chunk)))
+                chunk = []
+        else:
+            # Bulk delete can't cover messages this old, and history only gets older.
+            tasks.append(asyncio.ensure_future(delete_single(message)))
+
+    if len(chunk) > 1:
+        tasks.append(asyncio.ensure_future(delete_bulk(chunk)))
+    elif chunk:
+        tasks.append(asyncio.ensure_future(delete_single(chunk[0])))
+
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+
+        raise
+
+    return counts[0], counts[1]
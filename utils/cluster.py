@@ -0,0 +1,100 @@
+"""
+Run the bot as several shard processes sharing one database through `utils.broker`:
+
+    python -m utils.cluster [--shards N]
+
+Each shard runs `notus.py` with NOTUS_SHARD_ID, NOTUS_SHARD_COUNT and NOTUS_BROKER
+set. Shards which exit are restarted, and everything is stopped on Ctrl+C or SIGTERM.
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# Discord allows one gateway identify every 5 seconds per bot.
+IDENTIFY_DELAY = 5
+
+
+def wait_for(path: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+
+    while not os.path.exists(path):
+        if process.poll() is not None or time.monotonic() > deadline:
+            sys.exit("Broker failed to start.")
+
+        time.sleep(0.05)
+
+
+def main():
+    with open("config.json") as f:
+        config = json.load(f)
+
+    parser = argparse.ArgumentParser(description="Run Notus as several shards.")
+    parser.add_argument("--shards", type=int, default=config.get("NOTUS_SHARDS", 2))
+    parser.add_argument(
+        "--db",
+        default=os.environ.get(
+            "NOTUS_DB_PATH", config.get("NOTUS_DB_PATH", "./.notus_db")
+        ),
+    )
+    parser.add_argument("--socket", default="./.notus_db.sock")
+    args = parser.parse_args()
+
+    broker = subprocess.Popen(
+        [sys.executable, "-m", "utils.broker", "--db", args.db, "--socket", args.socket]
+    )
+    wait_for(args.socket, broker)
+
+    def spawn(shard: int) -> subprocess.Popen:
+        env = dict(
+            os.environ,
+            NOTUS_SHARD_ID=str(shard),
+            NOTUS_SHARD_COUNT=str(args.shards),
+            NOTUS_BROKER=args.socket,
+        )
+        return subprocess.Popen([sys.executable, "notus.py"], env=env)
+
+    shards = {}
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        for shard in range(args.shards):
+            if stopping:
+                break
+
+            shards[shard] = spawn(shard)
+            time.sleep(IDENTIFY_DELAY)
+
+        while not stopping and broker.poll() is None:
+            for shard, process in shards.items():
+                if process.poll() is not None:
+                    print(f"Shard {shard} exited with {process.returncode}, restarting")
+                    shards[shard] = spawn(shard)
+                    time.sleep(IDENTIFY_DELAY)
+
+            time.sleep(1)
+    finally:
+        for process in shards.values():
+            process.terminate()
+
+        for process in shards.values():
+            process.wait()
+
+        # Only stop the broker once no shard can still be flushing writes to it.
+        broker.terminate()
+        broker.wait()
+
+
+if __name__ == "__main__":
+    main()
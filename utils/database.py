@@ -1,164 +1,1398 @@
-import pickle
-from collections import UserDict, UserList
+import asyncio
+import itertools
+import random
+import struct
+import threading
+import time
+from collections import Counter, OrderedDict, UserDict, UserList, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import wraps
-from typing import List, Union
+from typing import Optional, Tuple, Union
 
 import plyvel
 
+from utils.metrics import Instrumentation
+from utils.serialization import Serializer
 
-def maybe_decode(x: Union[int, bytes]) -> Union[int, str]:
-    return x.decode() if isinstance(x, bytes) else x
+CacheInfo = namedtuple(
+    "CacheInfo", ["hits", "misses", "maxsize", "maxbytes", "currsize", "currbytes"]
+)
 
+_missing = object()
 
-def maybe_decode_all(list_: List[Union[int, bytes]]) -> List[Union[int, str]]:
-    return [maybe_decode(x) for x in list_]
+SEP = b"\x00"  # Separates path components of flattened keys
+
+# Keys starting with SEP hold bookkeeping which isn't encoded with the codec.
+COUNT_KEY = SEP + b"count"
+COUNT_PREFIX = COUNT_KEY + b":"
+# Expiry index: EXPIRE_PREFIX + expiry time in milliseconds + key, ordered by expiry.
+EXPIRE_PREFIX = SEP + b"expire:"
+EXPIRES = struct.Struct("!Q")
+
+# Keys hash to one of this many change counters, see `PlyvelDict._fill`.
+VERSION_SLOTS = 4096
+# Attempts at a write another process keeps changing the value under.
+WRITE_ATTEMPTS = 10
+
+
+def _bounds(prefix: str, start: str, stop: str, reverse: bool) -> dict:
+    """Build plyvel iterator arguments for a prefix or a `[start, stop)` key range."""
+    kwargs = {"reverse": reverse}
+
+    if prefix is not None:
+        kwargs["prefix"] = prefix.encode()
+    if start is not None:
+        kwargs["start"] = start.encode()
+    if stop is not None:
+        kwargs["stop"] = stop.encode()
+
+    return kwargs
+
+
+def _root_name(key: bytes) -> str:
+    """Get the top-level key a (possibly flattened or internal) key belongs to."""
+    return key.split(SEP, 1)[0].decode(errors="replace") or "<internal>"
+
+
+def _expire_key(key: bytes, expires: int) -> bytes:
+    return EXPIRE_PREFIX + EXPIRES.pack(expires) + key
+
+
+def _parse_expire_key(index_key: bytes) -> Tuple[int, bytes]:
+    offset = len(EXPIRE_PREFIX)
+    return (
+        EXPIRES.unpack_from(index_key, offset)[0],
+        index_key[offset + EXPIRES.size :],
+    )
+
+
+def _now() -> int:
+    return int(time.time() * 1000)
+
+
+def namespace(key: bytes) -> bytes:
+    """Get the part of a key before the first colon, used for grouping statistics."""
+    return key.split(b":", 1)[0]
+
+
+class _Child:
+    """Placeholder for a container stored under its own key in flat mode."""
+
+    __slots__ = ()
+
+    def __reduce__(self):
+        return "CHILD"  # Pickle as a reference to the module-level singleton
+
+    def __repr__(self):
+        return "<child>"
+
+
+CHILD = _Child()
+
+
+class WriteConflict(Exception):
+    """A write was based on a value another process changed in the meantime."""
+
+    def __init__(self, keys):
+        super().__init__(f"Changed concurrently: {', '.join(map(repr, keys))}")
+        self.keys = keys
 
 
 def call_super_and_put(func):
     @wraps(func)
     def decorator(self, *args, **kwargs):
         ret = getattr(super(self.__class__, self), func.__name__)(*args, **kwargs)
-        self._put()
+        latest = self._put((func.__name__, args, kwargs))
 
-        return ret
+        # When made again on a newer value, that call's result is the one that counts.
+        return ret if latest is _missing or latest is CHILD else latest
 
     return decorator
 
 
+class LRUCache:
+    """
+    Bounded mapping which evicts the least recently used entries once either the entry
+    limit or the byte limit is exceeded. A limit of 0 means unbounded. Thread-safe.
+    """
+
+    def __init__(self, maxsize: int = 0, maxbytes: int = 0):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+
+            return value
+
+    def peek(self, key, default=None):
+        """Get a value without counting a hit or miss or marking it as recently used."""
+        entry = self._data.get(key)
+        return default if entry is None else entry[0]
+
+    def put(self, key, value, size: int):
+        with self._lock:
+            self._pop(key)
+
+            if self.maxbytes and size > self.maxbytes:
+                return  # Would evict everything else and still not fit
+
+            self._data[key] = (value, size)
+            self._bytes += size
+
+            while (self.maxsize and len(self._data) > self.maxsize) or (
+                self.maxbytes and self._bytes > self.maxbytes
+            ):
+                _, (_, evicted) = self._data.popitem(last=False)
+                self._bytes -= evicted
+
+    def pop(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(
+            self.hits,
+            self.misses,
+            self.maxsize,
+            self.maxbytes,
+            len(self._data),
+            self._bytes,
+        )
+
+
 class PlyvelDict:
     """
     Wrapper for plyvel to emulate a dictionary interface to LevelDB.
+
+    Passing `cache_size` (entries) and/or `cache_bytes` (encoded size) enables a
+    write-through cache of decoded values, so hot keys skip unpickling on every read.
+    Cached objects are shared between reads, so data returned by `to_original()` should
+    be treated as read-only and changed through the proxies instead.
+
+    With `flat=True`, containers nested under string keys of a dict are stored under
+    their own path-encoded key (e.g. `settings\\x00blacklist`), so changing them only
+    rewrites that container instead of the whole top-level value. Flat mode can read
+    databases written without it, but not the other way around. Keys containing NUL
+    bytes are reserved for this.
+
+    Values are encoded with `codec` (see `utils.serialization`), falling back to pickle
+    for values it can't handle. Values written by any codec can always be read.
+
+    Writes made inside `with db.batch():` are buffered, coalesced per key and committed
+    atomically in a single LevelDB write batch. `start_group_commit()` buffers all
+    writes and commits them in the background on a time or size threshold instead.
+
+    The number of keys, in total and per namespace (see `namespace`), is kept up to
+    date alongside writes, so `len()` and `stats()` don't need to scan the database.
+
+    Keys can be given a time to live with `set(key, value, ttl=...)` or `expire`. Reads
+    treat expired keys as missing right away, and `start_sweeper()` deletes them in the
+    background a few at a time, oldest first. Until then they still count in `len()`.
     """
 
-    def __init__(self, path: str):
-        self._db = plyvel.DB(path, create_if_missing=True)
+    def __init__(
+        self,
+        path: Union[str, plyvel.DB],
+        cache_size: int = 0,
+        cache_bytes: int = 0,
+        flat: bool = False,
+        codec: str = "pickle",
+    ):
+        # Also accept an already opened database, or anything quacking like one.
+        self._db = (
+            plyvel.DB(path, create_if_missing=True) if isinstance(path, str) else path
+        )
+        self._serializer = Serializer(codec)
+        self._cache = (
+            LRUCache(cache_size, cache_bytes) if cache_size or cache_bytes else None
+        )
+        self._flat = flat
+        # Shared with other processes, which can make guarded writes fail, see `_guard`.
+        self._shared = getattr(self._db, "shared", False)
+        self._guards = {}  # key -> encoded value the pending writes were based on
+        # Bumped after each change to a key hashing to the slot, under `_cache_lock`.
+        self._versions = [0] * VERSION_SLOTS
+        self._cache_lock = threading.Lock()
+
+        self._lock = threading.RLock()
+        self._pending = {}  # key -> encoded value, or None for deletion
+        self._undo = None  # key -> pending value before the current batch
+        self._batch_depth = 0
+        self._group_commit = None
+        self._max_pending = 0
+        self._sweeper = None
+
+        self._count = 0
+        self._counts = {}  # namespace -> number of keys
+        self._counts_stale = False  # Changed by another process, see `invalidate`
+        self._load_counts()
+
+        self._expires = {}  # key -> expiry time in milliseconds
+        self._load_expires()
+
+        self._watchers = []
+        self.metrics = None
+
+    def _load_counts(self):
+        total = self._db.get(COUNT_KEY)
+
+        if total is None:
+            # First open since counts were added, so count once and remember.
+            counts = Counter(
+                namespace(key)
+                for key in self._db.iterator(include_value=False)
+                if SEP not in key
+            )
+
+            with self._db.write_batch(transaction=True) as wb:
+                for ns, count in counts.items():
+                    wb.put(COUNT_PREFIX + ns, str(count).encode())
+
+                wb.put(COUNT_KEY, str(sum(counts.values())).encode())
+
+            total = sum(counts.values())
+        else:
+            counts = {
+                key[len(COUNT_PREFIX) :]: int(count)
+                for key, count in self._db.iterator(prefix=COUNT_PREFIX)
+            }
+
+        self._count = int(total)
+        self._counts = dict(counts)
+
+    def _load_expires(self):
+        entries = self._db.iterator(prefix=EXPIRE_PREFIX, include_value=False)
+        self._expires = dict(
+            reversed(_parse_expire_key(index_key)) for index_key in entries
+        )
+
+    def _expired(self, key: bytes) -> bool:
+        expires = self._expires.get(key)
+        return expires is not None and expires <= _now()
+
+    def _set_expiry(self, key: bytes, expires: Optional[int]):
+        """Replace the expiry time of a key in the index. Call inside a batch."""
+        with self._lock:
+            old = self._expires.pop(key, None)
+
+            if old is not None:
+                self._put_raw(_expire_key(key, old), None)
+            if expires is not None:
+                self._expires[key] = expires
+                self._put_raw(_expire_key(key, expires), b"")
+
+    def _refresh_counts(self):
+        if self._counts_stale:
+            with self._lock:
+                self._counts_stale = False
+                self._load_counts()
+
+    def _change_count(self, key: bytes, delta: int):
+        """Adjust key counts for a key being added or removed. Call inside a batch."""
+        ns = namespace(key)
+
+        with self._lock:
+            self._refresh_counts()
+            self._count += delta
+            count = self._counts.get(ns, 0) + delta
+
+            if count:
+                self._counts[ns] = count
+                self._put_raw(COUNT_PREFIX + ns, str(count).encode())
+            else:
+                self._counts.pop(ns, None)
+                self._put_raw(COUNT_PREFIX + ns, None)
+
+            self._put_raw(COUNT_KEY, str(self._count).encode())
+
+    def _exists(self, key: bytes) -> bool:
+        if self._expires and self._expired(key):
+            return False
+        if self._cache is not None and key in self._cache:
+            return True
+
+        return self._get_raw(key) is not None
+
+    def _stored(self, key: bytes) -> bool:
+        """Whether a key is stored and counted, even if it expired but wasn't swept."""
+        if key in self._expires:
+            return self._get_raw(key) is not None
+
+        return self._exists(key)
+
+    def _get_raw(self, key: bytes):
+        """Read an encoded value, seeing writes which haven't been committed yet."""
+        if self._pending:
+            with self._lock:
+                if key in self._pending:
+                    return self._pending[key]
+
+        return self._db.get(key)
+
+    def _put_raw(self, key: bytes, raw):
+        """Write (or with `raw=None`, delete) an encoded value, buffering if needed."""
+        with self._lock:
+            if not self._batch_depth and self._group_commit is None:
+                if raw is None:
+                    self._db.delete(key)
+                else:
+                    self._db.put(key, raw)
+            else:
+                if self._undo is not None and key not in self._undo:
+                    self._undo[key] = self._pending.get(key, _missing)
+
+                self._pending[key] = raw
+
+            self._changed(key)
+
+            if not self._batch_depth:
+                self._flush_if_full()
+
+    def _flush_if_full(self):
+        """Under group commit, flush early once `max_pending` keys are waiting."""
+        if self._max_pending and len(self._pending) >= self._max_pending:
+            self.flush()
+
+    def _changed(self, key: bytes, cached=_missing, size: int = 0):
+        """
+        Count a change to a key made visible to readers, and replace its cached value
+        with `cached`, or drop it.
+        """
+        with self._cache_lock:
+            self._versions[hash(key) % VERSION_SLOTS] += 1
+
+            if self._cache is None:
+                return
+            if cached is _missing:
+                self._cache.pop(key)
+            else:
+                self._cache.put(key, cached, size)
+
+    def _version(self, key: bytes) -> int:
+        return self._versions[hash(key) % VERSION_SLOTS]
 
-    def _get(self, key: str):
+    def _fill(self, key: bytes, item, size: int, version: int):
         """
-        Private get function, for removing intermediate `self._db` stuff + auto encoding keys.
+        Cache a value read while its slot's version was `version`, unless the key may
+        have changed since. Otherwise a write landing between the read and this could
+        be overwritten by the older value, which later reads would keep getting.
         """
-        return self._db.get(key.encode())
+        with self._cache_lock:
+            if self._version(key) == version:
+                self._cache.put(key, item, size)
 
-    def __del__(self):
-        self._db.close()
+    def _guard(self, key: bytes, raw):
+        """
+        Make the current batch fail with `WriteConflict` if another process changed a
+        key from `raw` (None if missing) before the batch is committed. Only has an
+        effect on shared databases, as the lock rules out changes within a process.
+        """
+        if self._shared:
+            with self._lock:
+                self._guards.setdefault(key, raw)
 
-    def __getitem__(self, key: str):
-        item = self._get(key)
+    def _load(self, key: bytes):
+        """Get the decoded value of an encoded key, using the cache if enabled."""
+        if self._expires and self._expired(key):
+            raise KeyError(key.decode())
+
+        if self._cache is not None:
+            item = self._cache.get(key, _missing)
+
+            if item is not _missing:
+                return item
+
+            version = self._version(key)
+
+        raw = self._get_raw(key)
+
+        if raw is None:
+            raise KeyError(key.decode())
+
+        item = self._decode(key, raw)
+
+        if self._cache is not None:
+            self._fill(key, item, len(raw), version)
+
+        return item
+
+    def _encode(self, key: bytes, value) -> bytes:
+        return self._serializer.dumps(value)
+
+    def _decode(self, key: bytes, raw: bytes):
+        return self._serializer.loads(raw)
+
+    def _write(self, key: bytes, value):
+        """Encode and write a single value, updating the cache if enabled."""
+        raw = self._encode(key, value)
+
+        if self._cache is None:
+            return self._put_raw(key, raw)
+
+        # Cache a fresh copy so later changes to `value` can't leak into it, replacing
+        # what's cached under the lock so concurrent writes are cached in order too.
+        fresh = self._decode(key, raw)
+
+        with self._lock:
+            self._put_raw(key, raw)
+            self._changed(key, fresh, len(raw))
+
+    def _delete(self, key: bytes):
+        self._put_raw(key, None)
+
+    def _store(self, key: bytes, value):
+        """Write a value, giving nested containers their own keys in flat mode."""
+        if not self._flat:
+            return self._write(key, value)
+
+        nodes = {}
+        self._flatten(key, value, nodes)
+        node = nodes[key]
+
+        try:
+            old = self._load(key)
+        except KeyError:
+            old = None
+
+        if isinstance(old, dict):
+            # Drop children which were removed or replaced.
+            for k, v in old.items():
+                if v is not CHILD:
+                    continue
+
+                child = key + SEP + k.encode()
+
+                if (
+                    not isinstance(node, dict)
+                    or node.get(k) is not CHILD
+                    or child in nodes
+                ):
+                    self._remove_tree(child)
+
+        for node_key, node in nodes.items():
+            self._write(node_key, node)
+
+    def _flatten(self, key: bytes, value, nodes: dict):
+        if isinstance(value, PlyvelResult):
+            value = value.to_original()
+
+        if isinstance(value, dict):
+            node = {}
+
+            for k, v in value.items():
+                if isinstance(v, PlyvelResult):
+                    v = v.to_original()
+
+                if isinstance(k, str) and isinstance(v, (dict, list)):
+                    self._flatten(key + SEP + k.encode(), v, nodes)
+                    v = CHILD
+
+                node[k] = v
+
+            value = node
+
+        nodes[key] = value
+
+    def _materialize(self, key: bytes, item, load=None):
+        """Rebuild a value from its flattened node and child keys."""
+        if not isinstance(item, dict):
+            return item
 
-        if item is None:
-            raise KeyError(key)
+        load = load or self._load
+        data = {}
 
-        item = pickle.loads(item)
+        for k, v in item.items():
+            if v is CHILD:
+                child = key + SEP + k.encode()
+                v = self._materialize(child, load(child), load)
 
+            data[k] = v
+
+        return data
+
+    def _remove(self, key: bytes):
+        if self._flat:
+            self._remove_tree(key)
+        else:
+            self._delete(key)
+
+    def _remove_tree(self, key: bytes):
+        """Delete a key along with every flattened child below it."""
+        prefix = key + SEP
+        children = set(self._db.iterator(prefix=prefix, include_value=False))
+
+        with self._lock:
+            children.update(k for k in self._pending if k.startswith(prefix))
+
+        for child in children:
+            self._delete(child)
+
+        self._delete(key)
+
+    def _write_back(self, result: "PlyvelResult", op: Tuple):
+        """
+        Write a change made to the data of a proxy back to where it lives in its
+        top-level value. `op` is the `(method, args, kwargs)` call which made it. If
+        the value changed since the proxy read it, e.g. through another proxy or in
+        another process, the call is made again on the latest value instead, so
+        neither change is lost. Returns the result of that call, or `_missing`.
+        """
+        root = result._keys[0] if result._keys else result._key
+
+        for attempt in range(WRITE_ATTEMPTS):
+            try:
+                with self.batch():
+                    return self._redo(result, root, op)
+            except WriteConflict as e:
+                if attempt == WRITE_ATTEMPTS - 1:
+                    raise
+
+                self._conflicted(e, attempt)
+
+    def _redo(self, result: "PlyvelResult", root: bytes, op: Tuple):
+        # Read before checking the version, so a change can't slip in between.
+        raw = self._get_raw(root)
+        item = None
+        latest = _missing
+
+        if self._version(root) != result._version:
+            if raw is None:
+                raise KeyError(root.decode())
+
+            item = self._decode(root, raw)
+            container = item
+
+            for key_ in (*result._keys[1:], result._key) if result._keys else ():
+                container = container[key_]
+
+            name, args, kwargs = op
+            latest = getattr(container, name)(*args, **kwargs)
+            result.data = container.copy()
+
+        if not result._keys:
+            self._store(root, result.data)
+
+            if self._flat:
+                # Containers it now holds were moved under their own keys, which
+                # proxies taken from it from now on have to go through.
+                result.data = self._load(root).copy()
+        else:
+            item = self._load(root) if item is None else item
+            ref = item
+
+            for key_ in result._keys[1:]:
+                ref = ref[key_]
+
+            ref[result._key] = result.data
+            self._store(root, item)
+
+        self._guard(root, raw)
+        result._version = self._version(root)
+        return latest
+
+    def _conflicted(self, error: WriteConflict, attempt: int):
+        """
+        Forget keys a write conflicted on, so retrying reads their latest value, and
+        back off a little so processes writing the same key take turns.
+        """
+        for key in error.keys:
+            self._changed(key)
+
+        time.sleep(random.uniform(0, 0.001 * 2**attempt))
+
+    def _get(self, key: bytes):
+        """Read a key wrapped in a proxy, which knows what version it read."""
+        version = self._version(key)
+        return self._wrap(key, self._load(key), version=version)
+
+    def _wrap(self, key, item, keys: Tuple = (), version: int = None):
+        """
+        Wrap mutable collections in a proxy which writes changes back. `version` is
+        that of the top-level key when it was read, if known.
+        """
         if isinstance(item, dict):
-            return PlyvelDictResult(self._db, key, item)
+            return PlyvelDictResult(self, key, item, keys, version)
         elif isinstance(item, list):
-            return PlyvelListResult(self._db, key, item)
+            return PlyvelListResult(self, key, item, keys, version)
 
         return item
 
+    @contextmanager
+    def batch(self):
+        """
+        Buffer writes made inside the block and commit them atomically on exit, or drop
+        them if it raises. Nested batches join the outermost one. The block holds the
+        lock throughout, so batches of different threads run one at a time and other
+        threads' writes can't end up in this one's commit or rollback.
+        """
+        with self._lock:
+            if not self._batch_depth:
+                self._undo = {}
+
+            self._batch_depth += 1
+
+            try:
+                yield self
+            except BaseException:
+                self._batch_depth -= 1
+
+                if not self._batch_depth:
+                    self._rollback()
+
+                raise
+            else:
+                self._batch_depth -= 1
+
+                if not self._batch_depth:
+                    try:
+                        # Group commit writes the whole batch in one go later, but
+                        # guarded writes need to know now whether they went through.
+                        if self._group_commit is None or self._guards:
+                            self.flush()
+                        else:
+                            self._flush_if_full()
+                    except WriteConflict:
+                        self._rollback()
+                        raise
+
+                    self._undo = None
+
+    def flush(self):
+        """
+        Commit all buffered writes in a single atomic write batch. Raises
+        `WriteConflict`, leaving them buffered, if a guarded key changed meanwhile.
+        """
+        with self._lock:
+            guards, self._guards = self._guards, {}
+
+            if not self._pending:
+                return
+
+            with self._db.write_batch(transaction=True) as wb:
+                for key, raw in guards.items():
+                    wb.expect(key, raw)
+
+                for key, raw in self._pending.items():
+                    if raw is None:
+                        wb.delete(key)
+                    else:
+                        wb.put(key, raw)
+
+            self._pending = {}
+
+    def _rollback(self):
+        """Undo writes of the current batch, along with cached values and counts."""
+        undo, self._undo = self._undo, None
+        self._guards = {}
+
+        for key, raw in undo.items():
+            if raw is _missing:
+                self._pending.pop(key, None)
+            else:
+                self._pending[key] = raw
+
+            self._changed(key)
+
+        for key in undo:
+            if key.startswith(EXPIRE_PREFIX):
+                expires, key = _parse_expire_key(key)
+
+                if self._get_raw(_expire_key(key, expires)) is not None:
+                    self._expires[key] = expires
+                elif self._expires.get(key) == expires:
+                    del self._expires[key]
+
+        if any(key.startswith(COUNT_KEY) for key in undo):
+            self._count = int(self._get_raw(COUNT_KEY) or 0)
+
+            for key in undo:
+                if key.startswith(COUNT_PREFIX):
+                    ns = key[len(COUNT_PREFIX) :]
+                    count = int(self._get_raw(key) or 0)
+
+                    if count:
+                        self._counts[ns] = count
+                    else:
+                        self._counts.pop(ns, None)
+
+    def start_group_commit(self, interval: float = 0.05, max_pending: int = 1000):
+        """
+        Buffer every write and commit them together every `interval` seconds, or as soon
+        as `max_pending` keys are waiting. Writes are lost if the process dies before
+        they're flushed.
+        """
+        if self._group_commit is not None:
+            return
+
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                with self._lock:
+                    if not self._batch_depth:
+                        self.flush()
+
+        self._max_pending = max_pending
+        self._group_commit = stop
+        threading.Thread(
+            target=run, name="PlyvelDict group commit", daemon=True
+        ).start()
+
+    def stop_group_commit(self):
+        """Stop committing in the background and flush anything still buffered."""
+        if self._group_commit is None:
+            return
+
+        with self._lock:
+            self._group_commit.set()
+            self._group_commit = None
+            self._max_pending = 0
+
+            if not self._batch_depth:
+                self.flush()
+
+    def sweep(self, limit: int = 500) -> int:
+        """
+        Delete up to `limit` expired keys, those which expired first first, in one
+        batch. Returns how many index entries were handled.
+        """
+        self._sync()
+        due = self._db.iterator(
+            start=EXPIRE_PREFIX,
+            stop=_expire_key(b"", _now() + 1),
+            include_value=False,
+        )
+        due = list(itertools.islice(due, limit))
+
+        with self.batch():
+            for index_key in due:
+                expires, key = _parse_expire_key(index_key)
+
+                # The key may have been set again since the index was read.
+                if self._expires.get(key) == expires:
+                    if self._stored(key):
+                        self._change_count(key, -1)
+
+                    self._remove(key)
+                    del self._expires[key]
+
+                self._put_raw(index_key, None)
+
+        return len(due)
+
+    def start_sweeper(self, interval: float = 1, limit: int = 500):
+        """Delete expired keys in the background, at most `limit` every `interval`."""
+        if self._sweeper is not None:
+            return
+
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                if self._expires:
+                    self.sweep(limit)
+
+        self._sweeper = stop
+        threading.Thread(target=run, name="PlyvelDict sweeper", daemon=True).start()
+
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper.set()
+            self._sweeper = None
+
+    def apply_raw(self, changes) -> dict:
+        """
+        Write `(key, encoded value)` pairs, with a value of None deleting, atomically
+        and keeping key counts, e.g. as received from another process. Writes to the
+        counts themselves are ignored. Returns every key written, counts included.
+        """
+        with self.batch():
+            for key, raw in changes:
+                if key.startswith(COUNT_KEY):
+                    continue
+
+                if SEP not in key and (self._get_raw(key) is None) != (raw is None):
+                    self._change_count(key, -1 if raw is None else 1)
+
+                self._put_raw(key, raw)
+
+            with self._lock:
+                return dict(self._pending)
+
+    def invalidate(self, changes: dict):
+        """
+        Forget cached values of keys another process changed, given as a mapping of
+        encoded keys to whether they still exist, and tell `watch`ers.
+        """
+        for key, exists in changes.items():
+            if key.startswith(COUNT_KEY):
+                self._counts_stale = True
+                continue
+            if key.startswith(EXPIRE_PREFIX):
+                expires, key = _parse_expire_key(key)
+
+                if exists:
+                    self._expires[key] = expires
+                elif self._expires.get(key) == expires:
+                    self._expires.pop(key, None)
+
+                continue
+
+            self._changed(key)
+
+            if SEP not in key:
+                for callback in self._watchers:
+                    callback(key.decode(), exists)
+
+    def watch(self, callback):
+        """
+        Call `callback(key, exists)` for top-level keys changed by another process.
+        It may run on any thread, so it should only update state kept in memory.
+        """
+        self._watchers.append(callback)
+
+    def close(self):
+        # Also called from `__del__` when `__init__` failed, maybe before opening.
+        db = getattr(self, "_db", None)
+
+        if db is None or db.closed:
+            return
+
+        self.stop_sweeper()
+        self.stop_group_commit()
+        self.flush()
+        self._db.close()
+
+    def __del__(self):
+        self.close()
+
+    def __getitem__(self, key: str):
+        return self._get(key.encode())
+
     def __setitem__(self, key: str, value):
-        self._db.put(key.encode(), pickle.dumps(value))
+        self.set(key, value)
 
     def __delitem__(self, key: str):
-        self._db.delete(key.encode())
+        key = key.encode()
+
+        with self.batch():
+            if self._stored(key):
+                self._change_count(key, -1)
+            if key in self._expires:
+                self._set_expiry(key, None)
+
+            self._remove(key)
+
+    def set(self, key: str, value, ttl: float = None):
+        """Set a key, which expires after `ttl` seconds if given, or else never."""
+        key = key.encode()
+
+        # The batch holds the lock, so checking for the key, counting it and storing
+        # it can't interleave with another thread doing the same.
+        with self.batch():
+            if not self._stored(key):
+                self._change_count(key, 1)
+            if ttl is not None:
+                self._set_expiry(key, _now() + int(ttl * 1000))
+            elif key in self._expires:
+                self._set_expiry(key, None)
+
+            self._store(key, value)
+
+    def modify(self, key: str, func, default=_missing):
+        """
+        Replace the value of a key with `func(value)` as one change, and return it.
+        If another process changed the value in between, `func` is called again with
+        the latest one, so e.g. counters don't lose increments. `func` gets a plain
+        copy, or `default` if the key is missing.
+        """
+        key = key.encode()
+
+        def read(key_):
+            raw = self._get_raw(key_)
+            self._guard(key_, raw)
+
+            if raw is None:
+                raise KeyError(key_.decode())
+
+            return self._decode(key_, raw)
+
+        for attempt in range(WRITE_ATTEMPTS):
+            try:
+                with self.batch():
+                    ttl = None
+
+                    try:
+                        if self._expires and self._expired(key):
+                            raise KeyError(key.decode())
+
+                        value = read(key)
+                        value = self._materialize(key, value, read)
+                        expires = self._expires.get(key)
+                        ttl = None if expires is None else (expires - _now()) / 1000
+                    except KeyError:
+                        if default is _missing:
+                            raise
+
+                        value = default
+
+                    value = func(value)
+                    self.set(key.decode(), value, ttl)
+                    return value
+            except WriteConflict as e:
+                if attempt == WRITE_ATTEMPTS - 1:
+                    raise
+
+                self._conflicted(e, attempt)
+
+    def expire(self, key: str, ttl: Optional[float]):
+        """Make an existing key expire after `ttl` seconds, or never with None."""
+        key = key.encode()
+
+        with self.batch():
+            if not self._exists(key):
+                raise KeyError(key.decode())
+
+            self._set_expiry(key, None if ttl is None else _now() + int(ttl * 1000))
+
+    def ttl(self, key: str) -> Optional[float]:
+        """Get the seconds left before a key expires, or None if it never does."""
+        key = key.encode()
+
+        if not self._exists(key):
+            raise KeyError(key.decode())
+
+        expires = self._expires.get(key)
+        return None if expires is None else (expires - _now()) / 1000
 
     def __contains__(self, key: str):
-        return self._get(key) is not None
+        return self._exists(key.encode())
+
+    def _sync(self):
+        """Commit buffered writes so iterators see them, unless inside a batch."""
+        if self._pending and not self._batch_depth:
+            self.flush()
+
+    def keys(
+        self,
+        prefix: str = None,
+        start: str = None,
+        stop: str = None,
+        reverse: bool = False,
+    ):
+        """
+        Lazily iterate over keys in order, optionally only those starting with `prefix`
+        or within `[start, stop)`. `prefix` can't be combined with `start`/`stop`.
+        Writes buffered in an unfinished batch aren't seen.
+        """
+        self._sync()
+        iterator = self._db.iterator(
+            include_value=False, **_bounds(prefix, start, stop, reverse)
+        )
+
+        for key in iterator:
+            if SEP not in key and not (self._expires and self._expired(key)):
+                yield key.decode()
+
+    def values(self, *args, **kwargs):
+        """Lazily iterate over values, taking the same arguments as `keys`."""
+        for _, value in self.items(*args, **kwargs):
+            yield value
+
+    def items(
+        self,
+        prefix: str = None,
+        start: str = None,
+        stop: str = None,
+        reverse: bool = False,
+    ):
+        """
+        Lazily iterate over `(key, value)` pairs, taking the same arguments as `keys`.
+        Values are only decoded as they're reached, and come from the cache if present.
+        """
+        self._sync()
+
+        for key, raw in self._db.iterator(**_bounds(prefix, start, stop, reverse)):
+            if SEP in key or (self._expires and self._expired(key)):
+                continue
+
+            item = _missing if self._cache is None else self._cache.peek(key, _missing)
+
+            if item is _missing:
+                item = self._decode(key, raw)
+
+            yield key.decode(), self._wrap(key, item)
+
+    @contextmanager
+    def snapshot(self):
+        """
+        Get a read-only, consistent view of the database as of now, unaffected by any
+        writes made while it's open.
+        """
+        with self.raw_snapshot() as snapshot:
+            yield PlyvelSnapshot(self, snapshot)
+
+    @contextmanager
+    def raw_snapshot(self):
+        """Like `snapshot`, but yield the LevelDB snapshot itself, of encoded data."""
+        self._sync()
+        snapshot = self._db.snapshot()
+
+        try:
+            yield snapshot
+        finally:
+            snapshot.close()
+
+    def recount(self):
+        """
+        Count the keys again with a full scan and store the result, e.g. to repair
+        counts thrown off by concurrent writes in older versions.
+        """
+        with self._lock:
+            self.flush()
+
+            with self._db.write_batch(transaction=True) as wb:
+                for key in self._db.iterator(prefix=COUNT_KEY, include_value=False):
+                    wb.delete(key)
+
+            self._load_counts()
+
+    def replace_raw(self, items, batch_size: int = 10000):
+        """
+        Replace everything stored with encoded `(key, value)` pairs, e.g. read from a
+        backup, written `batch_size` at a time. Other writes wait until it's done, but
+        it isn't atomic. Key counts are recounted at the end.
+        """
+
+        def write(pairs):
+            batch = self._db.write_batch()
+
+            for i, (key, value) in enumerate(pairs, 1):
+                if value is None:
+                    batch.delete(key)
+                else:
+                    batch.put(key, value)
+
+                if i % batch_size == 0:
+                    batch.write()
+                    batch = self._db.write_batch()
+
+            batch.write()
+
+        with self._lock:
+            self.flush()
+            write((key, None) for key in self._db.iterator(include_value=False))
+            write(items)
+            write(
+                (key, None)
+                for key in self._db.iterator(prefix=COUNT_KEY, include_value=False)
+            )
+            self.cache_clear()
+            self._load_counts()
+            self._load_expires()
 
     def __iter__(self):
-        return self._db.iterator()
+        return self.keys()
 
     def __len__(self):
-        return sum(1 for _ in self._db.iterator(include_value=False))
+        self._refresh_counts()
+        return self._count
 
     def __reversed__(self):
-        return self._db.iterator(reverse=True)
+        return self.keys(reverse=True)
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self._db.name!r}{" closed" if self._db.closed else ""})'
 
+    def enable_metrics(self, max_keys: int = 1000) -> Instrumentation:
+        """
+        Start recording latencies and byte counts of gets, puts, deletes, proxy write
+        backs, encoding and decoding, per operation and per top-level key. This shadows
+        the internal methods with timed versions, so it costs nothing while disabled.
+        """
+        if self.metrics is not None:
+            return self.metrics
+
+        metrics = Instrumentation(max_keys)
+
+        def key(args):
+            return _root_name(args[0])
+
+        def size(data):
+            return len(data) if data else 0
+
+        def write_back_key(args):
+            result = args[0]
+            return _root_name(result._keys[0] if result._keys else result._key)
+
+        self._get_raw = metrics.timed(
+            "get", self._get_raw, key, lambda args, raw: size(raw)
+        )
+        self._put_raw = metrics.timed(
+            lambda args: "put" if args[1] is not None else "delete",
+            self._put_raw,
+            key,
+            lambda args, _: size(args[1]),
+        )
+        self._write_back = metrics.timed(
+            "nested put", self._write_back, write_back_key, lambda args, _: 0
+        )
+        self._encode = metrics.timed(
+            "encode", self._encode, key, lambda args, raw: len(raw)
+        )
+        self._decode = metrics.timed(
+            "decode", self._decode, key, lambda args, _: len(args[1])
+        )
+        self.flush = metrics.timed(
+            "commit", self.flush, lambda args: "<batch>", lambda args, _: 0
+        )
+        self.metrics = metrics
+
+        return metrics
+
+    def disable_metrics(self):
+        """Stop recording and go back to the untimed methods."""
+        for name in ("_get_raw", "_put_raw", "_write_back", "_encode", "_decode"):
+            self.__dict__.pop(name, None)
+
+        self.__dict__.pop("flush", None)
+        self.metrics = None
+
+    def stats(self) -> dict:
+        """
+        Get key counts, approximate on-disk sizes and cache usage, without scanning.
+        Sizes come from LevelDB's estimates, which skip data not yet flushed from its
+        in-memory table.
+        """
+        with self._lock:
+            self._refresh_counts()
+            counts = dict(self._counts)
+            total = self._count
+            pending = len(self._pending)
+
+        # A namespace covers both `ns`/`ns\x00...` and `ns:...` keys.
+        ranges = []
+
+        for ns in counts:
+            ranges += [(ns, ns + b"\x01"), (ns + b":", ns + b";")]
+
+        sizes = self._db.approximate_sizes(*ranges) if ranges else []
+
+        return {
+            "keys": total,
+            "approximate_bytes": self._db.approximate_size(b"", b"\xff"),
+            "namespaces": {
+                ns.decode(errors="replace"): {
+                    "keys": count,
+                    "approximate_bytes": sizes[i * 2] + sizes[i * 2 + 1],
+                }
+                for i, (ns, count) in enumerate(counts.items())
+            },
+            "pending_writes": pending,
+            "cache": self.cache_info()._asdict(),
+        }
+
+    def cache_info(self) -> CacheInfo:
+        """Get hit/miss counters and current usage of the value cache."""
+        if self._cache is None:
+            return CacheInfo(0, 0, 0, 0, 0, 0)
+
+        return self._cache.info()
+
+    def cache_clear(self):
+        """Drop all cached values, keeping the counters."""
+        with self._cache_lock:
+            self._versions = [x + 1 for x in self._versions]
+
+            if self._cache is not None:
+                self._cache.clear()
+
+
+class PlyvelSnapshot:
+    """
+    Read-only view of a `PlyvelDict` at a point in time, from `PlyvelDict.snapshot()`.
+    Values are returned as plain data rather than proxies.
+    """
 
-class PlyvelResult:
+    def __init__(self, db: PlyvelDict, snapshot):
+        self._db = db
+        self._snapshot = snapshot
+
+    def _load(self, key: bytes):
+        raw = None if self._db._expired(key) else self._snapshot.get(key)
+
+        if raw is None:
+            raise KeyError(key.decode())
+
+        return self._db._serializer.loads(raw)
+
+    def _decode(self, key: bytes, raw: bytes):
+        item = self._db._serializer.loads(raw)
+
+        if self._db._flat:
+            item = self._db._materialize(key, item, self._load)
+
+        return item
+
+    def keys(self, prefix=None, start=None, stop=None, reverse=False):
+        iterator = self._snapshot.iterator(
+            include_value=False, **_bounds(prefix, start, stop, reverse)
+        )
+
+        for key in iterator:
+            if SEP not in key and not self._db._expired(key):
+                yield key.decode()
+
+    def values(self, *args, **kwargs):
+        for _, value in self.items(*args, **kwargs):
+            yield value
+
+    def items(self, prefix=None, start=None, stop=None, reverse=False):
+        iterator = self._snapshot.iterator(**_bounds(prefix, start, stop, reverse))
+
+        for key, raw in iterator:
+            if SEP not in key and not self._db._expired(key):
+                yield key.decode(), self._decode(key, raw)
+
+    def __getitem__(self, key: str):
+        key = key.encode()
+        item = self._load(key)
+
+        return self._db._materialize(key, item, self._load) if self._db._flat else item
+
+    def __contains__(self, key: str):
+        key = key.encode()
+        return not self._db._expired(key) and self._snapshot.get(key) is not None
+
+    def __iter__(self):
+        return self.keys()
+
+
+class PlyvelSet:
     """
-    Base implementation of proxies for some collections returned by PlyvelDict.
+    Set stored as one key per member under `prefix`, mirrored in memory so membership
+    checks are a hash lookup without any disk access.
     """
 
-    def __init__(self, db: PlyvelDict, key: str, initial_data, keys: List[bytes] = []):
-        self._keys = keys
-        self._key = (
-            key.encode() if isinstance(key, str) else key
-        )  # Pre-encode key to reduce repetition
+    def __init__(self, db: PlyvelDict, prefix: str, type_=int):
         self._db = db
+        self._prefix = f"{prefix}:"
+        self._type = type_
 
-        super().__init__(initial_data)
+        start = len(self._prefix)
+        self._members = {type_(key[start:]) for key in db.keys(prefix=self._prefix)}
+        db.watch(self._changed)
 
-    def _put(self):
-        if not self._keys:
-            self._db.put(self._key, pickle.dumps(self.data))
-        else:
-            item = pickle.loads(self._db.get(self._keys[0]))
-            keys = maybe_decode_all(self._keys + [self._key])
-            our_key = maybe_decode(self._key)
+    def _changed(self, key: str, exists: bool):
+        if key.startswith(self._prefix):
+            member = self._type(key[len(self._prefix) :])
 
-            ref = item
+            if exists:
+                self._members.add(member)
+            else:
+                self._members.discard(member)
 
-            for key_ in keys[1:]:
-                if our_key in ref:
-                    ref[key_] = self.data
-                    break
+    def _key(self, member) -> str:
+        return f"{self._prefix}{member}"
 
-                ref = ref[key_]
+    def add(self, member):
+        if member not in self._members:
+            self._db[self._key(member)] = True
+            self._members.add(member)
 
-            self._db.put(self._keys[0], pickle.dumps(item))
+    def discard(self, member):
+        if member in self._members:
+            del self._db[self._key(member)]
+            self._members.discard(member)
 
-    def __getitem__(self, key):
-        item = super().__getitem__(key)
+    def __contains__(self, member):
+        return member in self._members
 
-        if isinstance(item, dict):
-            return PlyvelDictResult(self._db, key, item, self._keys + [self._key])
-        elif isinstance(item, list):
-            return PlyvelListResult(self._db, key, item, self._keys + [self._key])
-        else:
-            return item
+    def __iter__(self):
+        return iter(self._members)
 
-    def __setitem__(self, key, value):
-        super().__setitem__(key, value)
+    def __len__(self):
+        return len(self._members)
 
-        if not self._keys:
-            self._db.put(self._key, pickle.dumps(self.data))
-        else:
-            item = pickle.loads(self._db.get(self._keys[0]))
-            keys = maybe_decode_all(self._keys + [self._key])
-            ref = item
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self._prefix[:-1]!r}, {len(self)} members)"
 
-            for key_ in keys[1:]:
-                ref = ref[key_]
 
-            ref[key] = value
-            self._db.put(self._keys[0], pickle.dumps(item))
+class PlyvelResult:
+    """
+    Base implementation of proxies for some collections returned by PlyvelDict.
+    """
 
-    def __delitem__(self, key):
-        super().__delitem__(key)
+    def __init__(
+        self, db: PlyvelDict, key, initial_data, keys: Tuple = (), version: int = None
+    ):
+        # `keys` holds the path from the (encoded) root key down to our parent.
+        self._keys = keys
+        self._key = key
+        self._db = db
+        self._version = version  # Of the root key as read, see `_write_back`
 
-        if not self._keys:
-            self._db.put(self._key, pickle.dumps(self.data))
-        else:
-            item = pickle.loads(self._db.get(self._keys[0]))
-            keys = maybe_decode_all(self._keys + [self._key])
-            ref = item
+        # Set data directly, as `UserDict.__init__` goes through `update` and would
+        # write every item back.
+        super().__init__()
+        self.data = initial_data.copy()
 
-            for key_ in keys[1:]:
-                ref = ref[key_]
+    def _put(self, op: Tuple):
+        return self._db._write_back(self, op)
+
+    def __getitem__(self, key):
+        item = super().__getitem__(key)
+
+        if item is CHILD:
+            return self._db._get(self._key + SEP + key.encode())
+
+        return self._db._wrap(key, item, (*self._keys, self._key), self._version)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._put(("__setitem__", (key, value), {}))
 
-            del ref[key]
-            self._db.put(self._keys[0], pickle.dumps(item))
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._put(("__delitem__", (key,), {}))
 
     def __repr__(self):
-        return f"{type(self).__name__}({self.data})"
+        return f"{type(self).__name__}({self.to_original()})"
 
     def to_original(self):
         """Get unwrapped data."""
+        if self._db._flat and not self._keys:
+            return self._db._materialize(self._key, self.data)
+
         return self.data
 
 
@@ -167,13 +1401,20 @@ class PlyvelDictResult(PlyvelResult, UserDict):
     Intermediate value for dictionaries returned by `PlyvelDict`
     """
 
-    @call_super_and_put
-    def pop():
-        pass
+    def _inline(self, key):
+        """Pull a flattened child into our data, so it can be returned after removal."""
+        if self.data.get(key) is CHILD:
+            self.data[key] = self[key].to_original()
 
-    @call_super_and_put
-    def popitem():
-        pass
+    def pop(self, key, *args):
+        self._inline(key)
+        return super().pop(key, *args)
+
+    def popitem(self):
+        if self.data:
+            self._inline(next(iter(self.data)))
+
+        return super().popitem()
 
     @call_super_and_put
     def clear():
@@ -222,3 +1463,68 @@ class PlyvelListResult(PlyvelResult, UserList):
         pass
 
     # TODO: maybe also do this for stuff like += and -=
+
+
+class AsyncPlyvelDict:
+    """
+    Awaitable interface to a `PlyvelDict`, which runs LevelDB access and (de)serializing
+    on a dedicated, bounded thread pool so the event loop never waits on the disk.
+    The wrapped `db` stays usable synchronously.
+    """
+
+    def __init__(self, db: PlyvelDict, max_workers: int = 4):
+        self.db = db
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="PlyvelDict"
+        )
+
+    def run(self, func, *args):
+        """Run a blocking function on the database's thread pool."""
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get(self, key: str, default=None):
+        def get():
+            try:
+                return self.db[key]
+            except KeyError:
+                return default
+
+        return await self.run(get)
+
+    async def set(self, key: str, value, ttl: float = None):
+        await self.run(self.db.set, key, value, ttl)
+
+    async def delete(self, key: str):
+        await self.run(self.db.__delitem__, key)
+
+    async def contains(self, key: str) -> bool:
+        return await self.run(self.db.__contains__, key)
+
+    async def _iterate(self, iterator, chunk_size: int):
+        def take():
+            return [item for _, item in zip(range(chunk_size), iterator)]
+
+        while True:
+            chunk = await self.run(take)
+
+            for item in chunk:
+                yield item
+
+            if len(chunk) < chunk_size:
+                break
+
+    def keys(self, *args, chunk_size: int = 100, **kwargs):
+        """Async version of `PlyvelDict.keys`, reading `chunk_size` keys at a time."""
+        return self._iterate(self.db.keys(*args, **kwargs), chunk_size)
+
+    def items(self, *args, chunk_size: int = 100, **kwargs):
+        """Async version of `PlyvelDict.items`, reading `chunk_size` items at a time."""
+        return self._iterate(self.db.items(*args, **kwargs), chunk_size)
+
+    async def flush(self):
+        await self.run(self.db.flush)
+
+    async def close(self):
+        """Wait for queued operations, flush and shut down the pool."""
+        await self.flush()
+        self._executor.shutdown()
@@ -0,0 +1,176 @@
+import asyncio
+import time
+from collections import Counter, defaultdict, namedtuple
+from contextlib import asynccontextmanager
+from typing import Callable, Optional
+
+import aiohttp
+from yarl import URL
+
+from utils.database import LRUCache
+from utils.metrics import OperationStats
+
+CHUNK_SIZE = 64 * 1024
+
+# A response kept for revalidation, with the validators to send back.
+CachedResponse = namedtuple("CachedResponse", ["etag", "last_modified", "body"])
+
+
+class HTTPError(Exception):
+    pass
+
+
+class ResponseTooLarge(HTTPError):
+    pass
+
+
+class HTTPClient:
+    """
+    The bot's one HTTP session, created by `start` and reused for every request so
+    connections and DNS lookups are pooled. Bodies fetched with `fetch` are kept along
+    with their ETag or Last-Modified, and fetching them again only downloads them if
+    they changed. Latency and errors are counted per host, see `stats`.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 10,
+        dns_ttl: int = 300,
+        timeout: float = 30,
+        connect_timeout: float = 10,
+        cache_size: int = 256,
+        cache_bytes: int = 32 * 1024 * 1024,
+        max_hosts: int = 1000,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.max_hosts = max_hosts
+        self.hosts = defaultdict(OperationStats)
+        self.errors = defaultdict(Counter)  # host -> error -> count
+        self.revalidated = 0
+        self._cache = LRUCache(cache_size, cache_bytes)
+        self._session = None
+
+    async def start(self):
+        """Create the session. Needs a running event loop."""
+        if self._session is not None:
+            return
+
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_ttl,
+        )
+        self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            raise HTTPError("HTTP client isn't started")
+
+        return self._session
+
+    def _host(self, url: str) -> str:
+        host = URL(url).host or "<none>"
+
+        if host not in self.hosts and len(self.hosts) >= self.max_hosts:
+            return "<other>"
+
+        return host
+
+    @asynccontextmanager
+    async def request(self, method: str, url: str, **kwargs):
+        """
+        Like `session.request`, but raising for error statuses and recording the time
+        to the response headers, or the error, against the URL's host.
+        """
+        host = self._host(url)
+        start = time.perf_counter()
+
+        try:
+            async with self.session.request(method, url, **kwargs) as resp:
+                self.hosts[host].record(time.perf_counter() - start, 0)
+                resp.raise_for_status()
+                yield resp
+        except aiohttp.ClientResponseError as e:
+            self.errors[host][str(e.status)] += 1
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.errors[host][type(e).__name__] += 1
+            raise
+
+    async def fetch(
+        self,
+        url: str,
+        max_bytes: int = None,
+        check: Callable[[bytes], None] = None,
+        check_size: int = 16,
+        **kwargs,
+    ) -> bytes:
+        """
+        GET the body of `url`, stopping as soon as it's known to be larger than
+        `max_bytes`. `check` is called with the first `check_size` bytes, and can raise
+        to stop downloading something unwanted.
+        """
+        cached: Optional[CachedResponse] = self._cache.get(url)
+        headers = dict(kwargs.pop("headers", None) or {})
+
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        async with self.request("GET", url, headers=headers, **kwargs) as resp:
+            unchanged = resp.status == 304 and cached is not None
+            size = len(cached.body) if unchanged else resp.content_length
+
+            if max_bytes is not None and size is not None and size > max_bytes:
+                raise ResponseTooLarge(f"Response is larger than {max_bytes} bytes")
+            if unchanged:
+                self.revalidated += 1
+                return cached.body
+
+            data = bytearray()
+            checked = check is None
+
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                data += chunk
+
+                if max_bytes is not None and len(data) > max_bytes:
+                    raise ResponseTooLarge(f"Response is larger than {max_bytes} bytes")
+                if not checked and len(data) >= check_size:
+                    check(bytes(data[:check_size]))
+                    checked = True
+
+            body = bytes(data)
+
+            if not checked:
+                check(body)
+
+            self.hosts[self._host(url)].bytes += len(body)
+            etag = resp.headers.get("ETag")
+            last_modified = resp.headers.get("Last-Modified")
+
+        if etag or last_modified:
+            self._cache.put(url, CachedResponse(etag, last_modified, body), len(body))
+        else:
+            self._cache.pop(url)
+
+        return body
+
+    def stats(self) -> dict:
+        return {
+            "hosts": {host: stats.to_dict() for host, stats in self.hosts.items()},
+            "errors": {host: dict(errors) for host, errors in self.errors.items()},
+            "revalidated": self.revalidated,
+            "cache": self._cache.info()._asdict(),
+        }
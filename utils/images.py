@@ -0,0 +1,155 @@
+import hashlib
+import io
+from typing import Optional, Tuple
+
+from utils.database import PlyvelDict
+from utils.http import HTTPClient, ResponseTooLarge
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+MAX_DOWNLOAD = 16 * 1024 * 1024
+# Discord rejects avatars a bit above this, and never shows them larger than 1024px.
+AVATAR_MAX_BYTES = 8 * 1024 * 1024
+AVATAR_MAX_SIZE = 1024
+
+SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+class ImageError(Exception):
+    pass
+
+
+class UnsupportedImage(ImageError):
+    pass
+
+
+class ImageTooLarge(ImageError):
+    pass
+
+
+def sniff(data: bytes) -> Optional[str]:
+    """Get the mimetype of an image from its first bytes, rather than its name."""
+    for signature, mime in SIGNATURES:
+        if data.startswith(signature):
+            return mime
+
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+
+    return None
+
+
+def _check_image(head: bytes):
+    if sniff(head) is None:
+        raise UnsupportedImage("Not a PNG, JPEG, GIF or WebP image")
+
+
+async def fetch_image(
+    http: HTTPClient, url: str, max_bytes: int = MAX_DOWNLOAD
+) -> Tuple[bytes, str]:
+    """
+    Download an image, giving up as soon as the response is known to be larger than
+    `max_bytes` or to not start like an image, instead of reading all of it first.
+    """
+    try:
+        data = await http.fetch(url, max_bytes, check=_check_image, check_size=12)
+    except ResponseTooLarge:
+        raise ImageTooLarge(f"Image is larger than {max_bytes} bytes") from None
+
+    return data, sniff(data)
+
+
+def shrink(data: bytes, max_bytes: int, max_size: int) -> bytes:
+    """
+    Scale an image down to `max_size` pixels and re-encode it until it fits in
+    `max_bytes`. Blocking, and needs Pillow unless the image already fits.
+    """
+    if len(data) <= max_bytes:
+        return data
+
+    if Image is None:
+        raise ImageTooLarge(
+            f"Image is larger than {max_bytes} bytes, install Pillow to downscale it"
+        )
+
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail((max_size, max_size))
+
+    # Keep transparency if it fits, else fall back to increasingly lossy JPEG.
+    attempts = [("PNG", {"optimize": True})]
+    attempts += [("JPEG", {"quality": q}) for q in (90, 75, 60)]
+
+    for format_, options in attempts:
+        out = io.BytesIO()
+        image = image if format_ == "PNG" else image.convert("RGB")
+        image.save(out, format_, **options)
+
+        if out.tell() <= max_bytes:
+            return out.getvalue()
+
+    raise ImageTooLarge(f"Could not shrink image below {max_bytes} bytes")
+
+
+class ImageCache:
+    """
+    Prepared images stored by the hash of the download they were prepared from, so
+    setting an image whose download hasn't changed needs no preparing again. Downloads
+    themselves are revalidated by `HTTPClient.fetch`. Only the last `keep` images are
+    kept. Blocking, so best run on the database's pool.
+    """
+
+    def __init__(self, db: PlyvelDict, name: str, keep: int = 5):
+        self.db = db
+        self.name = name
+        self.keep = keep
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def _data_key(self, digest: str) -> str:
+        return f"{self.name}:{digest}"
+
+    def _index(self) -> dict:
+        try:
+            index = self.db[self.name].to_original()
+        except KeyError:
+            return {"recent": [], "current": None}
+
+        # Copied, so the database's cached value is only changed by writing it back.
+        return {"recent": list(index["recent"]), "current": index["current"]}
+
+    def get(self, digest: str) -> Optional[bytes]:
+        try:
+            return self.db[self._data_key(digest)]
+        except KeyError:
+            return None
+
+    def put(self, digest: str, data: bytes):
+        """Store an image prepared from the download hashing to `digest`."""
+        index = self._index()
+        recent = [x for x in index["recent"] if x != digest] + [digest]
+
+        with self.db.batch():
+            for old in recent[: -self.keep]:
+                del self.db[self._data_key(old)]
+
+            index["recent"] = recent[-self.keep :]
+            self.db[self._data_key(digest)] = data
+            self.db[self.name] = index
+
+    def current(self) -> Optional[str]:
+        return self._index()["current"]
+
+    def set_current(self, digest: str):
+        index = self._index()
+        index["current"] = digest
+        self.db[self.name] = index
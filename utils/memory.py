@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+import glob
+import linecache
+import os
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+from discord.ext import commands
+
+from utils.prefixes import compile_prefixes
+
+# Allocations made by tracemalloc and the import system only add noise.
+FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, linecache.__file__),
+)
+
+
+def short_path(filename: str) -> str:
+    """Trim a path to the part naming the module, as it would be imported."""
+    for path in sorted(filter(None, sys.path), key=len, reverse=True):
+        if filename.startswith(path + os.sep):
+            return filename[len(path) + 1 :]
+
+    return filename
+
+
+def _format(stat) -> str:
+    """Describe a `Statistic` or `StatisticDiff` by its innermost frame."""
+    frame = stat.traceback[0]
+    line = f"{short_path(frame.filename)}:{frame.lineno} {stat.size / 1024:.1f} KiB"
+
+    if isinstance(stat, tracemalloc.StatisticDiff):
+        line += f" ({stat.size_diff / 1024:+.1f} KiB, {stat.count_diff:+} blocks)"
+    else:
+        line += f" ({stat.count} blocks)"
+
+    return line
+
+
+class MemoryProfiler:
+    """
+    Trace allocations with tracemalloc, which slows down every allocation while on.
+    `diff` compares against the last `mark`, and `start_dumps` writes a snapshot to
+    `directory` every `interval` seconds, keeping the latest `keep`, for comparing
+    later with `python -m utils.memory OLD NEW`.
+    """
+
+    def __init__(self, directory: str = "./memory", keep: int = 24):
+        self.directory = directory
+        self.keep = keep
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._dumps: Optional[asyncio.Task] = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 1):
+        """Start tracing, remembering `frames` frames of each allocation's stack."""
+        if not self.tracing:
+            tracemalloc.start(frames)
+
+        self.mark()
+
+    def stop(self):
+        self.stop_dumps()
+        self._baseline = None
+        tracemalloc.stop()  # Frees all traces
+
+    def snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(FILTERS)
+
+    def mark(self):
+        """Take the snapshot later ones are compared to."""
+        self._baseline = self.snapshot()
+
+    def top(self, limit: int = 10, key_type: str = "lineno") -> List[str]:
+        """Describe the places which allocated most of the memory still in use."""
+        stats = self.snapshot().statistics(key_type)
+        return [_format(stat) for stat in stats[:limit]]
+
+    def diff(
+        self, limit: int = 10, key_type: str = "lineno", mark: bool = False
+    ) -> List[str]:
+        """
+        Describe the places whose memory use grew the most since the last `mark`, and
+        with `mark`, compare later ones to now instead.
+        """
+        snapshot = self.snapshot()
+        stats = snapshot.compare_to(self._baseline, key_type)
+
+        if mark:
+            self._baseline = snapshot
+
+        return [_format(stat) for stat in stats[:limit]]
+
+    def dump(self) -> str:
+        """Write a snapshot to disk, dropping old ones, and return its path."""
+        os.makedirs(self.directory, exist_ok=True)
+        # Shards of a cluster may share the directory, so each only prunes its own.
+        prefix = os.path.join(self.directory, f"notus-{os.getpid()}-")
+        path = prefix + time.strftime("%Y%m%d-%H%M%S.tracemalloc")
+        self.snapshot().dump(path)
+        dumps = sorted(glob.glob(f"{prefix}*.tracemalloc"))
+
+        for old in dumps[: -self.keep]:
+            os.remove(old)
+
+        return path
+
+    def start_dumps(self, interval: float):
+        """Dump a snapshot every `interval` seconds while tracing."""
+        self.stop_dumps()
+
+        async def run():
+            loop = asyncio.get_event_loop()
+
+            while self.tracing:
+                await asyncio.sleep(interval)
+                await loop.run_in_executor(None, self.dump)
+
+        self._dumps = asyncio.ensure_future(run())
+
+    def stop_dumps(self):
+        if self._dumps is not None:
+            self._dumps.cancel()
+            self._dumps = None
+
+    @property
+    def dumping(self) -> bool:
+        return self._dumps is not None and not self._dumps.done()
+
+
+def cache_sizes(bot: commands.Bot) -> Dict[str, str]:
+    """Describe how much the caches kept by discord.py and the bot itself hold."""
+    state = bot._connection
+    db_cache = bot.db.cache_info()
+    http_cache = bot.web.stats()["cache"]
+
+    return {
+        "guilds": str(len(state._guilds)),
+        "users": str(len(state._users)),
+        "members": str(sum(len(guild._members) for guild in bot.guilds)),
+        "emojis": str(len(state._emojis)),
+        "private channels": str(len(state._private_channels)),
+        "messages": str(len(state._messages or ())),
+        "database values": f"{db_cache.currsize}, {db_cache.currbytes // 1024} KiB",
+        "http responses": (
+            f"{http_cache['currsize']}, {http_cache['currbytes'] // 1024} KiB"
+        ),
+        "permissions": str(len(bot.permission_cache)),
+        "prefix patterns": str(compile_prefixes.cache_info().currsize),
+        "throttle buckets": str(sum(bot.throttler.stats()["buckets"].values())),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two tracemalloc snapshots.")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("-n", "--limit", type=int, default=25)
+    parser.add_argument("--traceback", action="store_true")
+    args = parser.parse_args()
+
+    old = tracemalloc.Snapshot.load(args.old)
+    new = tracemalloc.Snapshot.load(args.new)
+    key_type = "traceback" if args.traceback else "lineno"
+
+    for stat in new.compare_to(old, key_type)[: args.limit]:
+        print(_format(stat))
+
+        if args.traceback:
+            print("\n".join(f"    {line}" for line in stat.traceback.format()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import time
+from collections import defaultdict
+from functools import wraps
+
+BUCKETS = 32  # Powers of two of microseconds, up to about 35 minutes
+
+
+class OperationStats:
+    """Count, total time, byte count and a log2 latency histogram for one operation."""
+
+    __slots__ = ("count", "seconds", "bytes", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.buckets = [0] * BUCKETS
+
+    def record(self, seconds: float, nbytes: int):
+        self.count += 1
+        self.seconds += seconds
+        self.bytes += nbytes
+        self.buckets[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+
+    def percentile(self, pct: float) -> float:
+        """Upper bound in seconds of the bucket holding the given percentile."""
+        target = self.count * pct / 100
+        seen = 0
+
+        for i, count in enumerate(self.buckets):
+            seen += count
+
+            if count and seen >= target:
+                return (1 << i) / 1e6
+
+        return 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "seconds": self.seconds,
+            "bytes": self.bytes,
+            "mean": self.seconds / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "histogram": self.buckets,
+        }
+
+
+class Instrumentation:
+    """
+    Latency and byte counts per operation and per top-level key. Keys beyond `max_keys`
+    distinct ones are counted together under `<other>`.
+    """
+
+    def __init__(self, max_keys: int = 1000):
+        self.max_keys = max_keys
+        self.since = time.time()
+        self.operations = defaultdict(OperationStats)
+        self.keys = defaultdict(lambda: defaultdict(OperationStats))
+
+    def record(self, operation: str, key: str, seconds: float, nbytes: int = 0):
+        self.operations[operation].record(seconds, nbytes)
+
+        if key not in self.keys and len(self.keys) >= self.max_keys:
+            key = "<other>"
+
+        self.keys[key][operation].record(seconds, nbytes)
+
+    def timed(self, operation, func, key_of, size_of):
+        """
+        Wrap `func` to record each call, with `key_of(args)` naming the top-level key
+        and `size_of(args, result)` giving the number of bytes handled. `operation` can
+        also be a function of the arguments.
+        """
+        name_of = operation if callable(operation) else lambda args: operation
+
+        @wraps(func)
+        def wrapper(*args):
+            start = time.perf_counter()
+            result = func(*args)
+            elapsed = time.perf_counter() - start
+            self.record(name_of(args), key_of(args), elapsed, size_of(args, result))
+
+            return result
+
+        return wrapper
+
+    def report(self) -> dict:
+        return {
+            "since": self.since,
+            "operations": {
+                op: stats.to_dict() for op, stats in self.operations.items()
+            },
+            "keys": {
+                key: {op: stats.to_dict() for op, stats in ops.items()}
+                for key, ops in self.keys.items()
+            },
+        }
+
+    def reset(self):
+        self.since = time.time()
+        self.operations.clear()
+        self.keys.clear()
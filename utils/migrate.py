@@ -0,0 +1,83 @@
+"""
+Re-encode every value of a Notus database with another codec.
+
+    python -m utils.migrate --codec marshal ./.notus_db
+
+Must run while the bot is stopped, as LevelDB only allows a single process. Values are
+streamed in key order and written a batch at a time together with the last migrated key,
+so an interrupted run continues where it left off when started again.
+"""
+
+import argparse
+
+import plyvel
+
+from utils.database import SEP
+from utils.serialization import CODECS, Serializer
+
+PROGRESS_KEY = SEP + b"migrate"
+
+
+def migrate(path: str, codec: str, batch_size: int = 1000, compact: bool = True):
+    """Migrate the database at `path`, returning counts of what was done."""
+    serializer = Serializer(codec)
+    stats = {"keys": 0, "rewritten": 0, "bytes_before": 0, "bytes_after": 0}
+    db = plyvel.DB(path)
+
+    try:
+        start = db.get(PROGRESS_KEY)
+        iterator = db.iterator(start=start, include_start=False)
+        batch = db.write_batch()
+        pending = 0
+
+        for key, raw in iterator:
+            if key.startswith(SEP):
+                continue  # Internal bookkeeping, not encoded with a codec
+
+            new = serializer.dumps(serializer.loads(raw))
+            stats["keys"] += 1
+            stats["bytes_before"] += len(raw)
+            stats["bytes_after"] += len(new)
+
+            if new != raw:
+                batch.put(key, new)
+                stats["rewritten"] += 1
+
+            pending += 1
+
+            if pending >= batch_size:
+                batch.put(PROGRESS_KEY, key)
+                batch.write()
+                batch = db.write_batch()
+                pending = 0
+
+        batch.delete(PROGRESS_KEY)
+        batch.write()
+
+        if compact:
+            db.compact_range()
+    finally:
+        db.close()
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("path", nargs="?", default="./.notus_db")
+    parser.add_argument("--codec", choices=list(CODECS), default="marshal")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--no-compact", action="store_false", dest="compact")
+    args = parser.parse_args()
+
+    stats = migrate(args.path, args.codec, args.batch_size, args.compact)
+
+    print(
+        f"Migrated {stats['keys']} keys to {args.codec} "
+        f"({stats['rewritten']} rewritten), "
+        f"{stats['bytes_before']} -> {stats['bytes_after']} bytes of values."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+from collections import defaultdict
+from typing import Dict, Tuple
+
+import discord
+from discord.ext import commands
+
+Key = Tuple[int, int, Tuple[int, ...]]  # (channel id, member id, role ids)
+
+
+class PermissionCache:
+    """
+    Resolved channel permissions per (guild, channel, member and their roles), kept
+    until an event that could change them arrives. Resolving walks every role and
+    overwrite involved, which adds up in guilds with hundreds of them. Each guild holds
+    at most `max_entries`.
+
+    Role ids are part of the key because member updates aren't received without the
+    members intent, while every message carries its author's current roles.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._guilds: Dict[int, Dict[Key, discord.Permissions]] = defaultdict(dict)
+
+    def get(
+        self, member: discord.Member, channel: discord.abc.GuildChannel
+    ) -> discord.Permissions:
+        entries = self._guilds[member.guild.id]
+        key = (channel.id, member.id, tuple(x.id for x in member.roles))
+
+        try:
+            return entries[key]
+        except KeyError:
+            pass
+
+        if len(entries) >= self.max_entries:
+            entries.clear()
+
+        permissions = entries[key] = channel.permissions_for(member)
+        return permissions
+
+    def clear(self):
+        self._guilds.clear()
+
+    def __len__(self):
+        return sum(map(len, self._guilds.values()))
+
+    def attach(self, bot: commands.Bot):
+        """Listen to the events that invalidate entries on `bot`."""
+        for event in (
+            "on_member_update",
+            "on_member_remove",
+            "on_guild_role_create",
+            "on_guild_role_update",
+            "on_guild_role_delete",
+            "on_guild_channel_update",
+            "on_guild_channel_delete",
+            "on_guild_update",
+            "on_guild_remove",
+        ):
+            bot.add_listener(getattr(self, event))
+
+    def _drop_guild(self, guild: discord.Guild):
+        self._guilds.pop(guild.id, None)
+
+    def _drop_member(self, member: discord.Member):
+        entries = self._guilds.get(member.guild.id)
+
+        if entries:
+            for key in [x for x in entries if x[1] == member.id]:
+                del entries[key]
+
+    def _drop_channel(self, channel: discord.abc.GuildChannel):
+        entries = self._guilds.get(channel.guild.id)
+
+        # Overwrites on a category also apply to channels synced with it, so be broad.
+        if entries and isinstance(channel, discord.CategoryChannel):
+            self._drop_guild(channel.guild)
+        elif entries:
+            for key in [x for x in entries if x[0] == channel.id]:
+                del entries[key]
+
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.roles != after.roles:
+            self._drop_member(after)
+
+    async def on_member_remove(self, member: discord.Member):
+        self._drop_member(member)
+
+    async def on_guild_role_create(self, role: discord.Role):
+        self._drop_guild(role.guild)
+
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        self._drop_guild(after.guild)
+
+    async def on_guild_role_delete(self, role: discord.Role):
+        self._drop_guild(role.guild)
+
+    async def on_guild_channel_update(self, before, after):
+        self._drop_channel(after)
+
+    async def on_guild_channel_delete(self, channel):
+        self._drop_channel(channel)
+
+    async def on_guild_update(self, before: discord.Guild, after: discord.Guild):
+        self._drop_guild(after)
+
+    async def on_guild_remove(self, guild: discord.Guild):
+        self._drop_guild(guild)
@@ -0,0 +1,97 @@
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Pattern
+
+import discord
+
+from utils.database import PlyvelDict
+
+
+@lru_cache(maxsize=None)
+def compile_prefixes(prefixes: tuple) -> Optional[Pattern]:
+    """
+    Compile prefixes into a single anchored regex. Longer prefixes are tried first so
+    that e.g. `!!` wins over `!`. Identical prefix sets share one pattern.
+    """
+    if not prefixes:
+        return None
+
+    ordered = sorted(set(prefixes), key=len, reverse=True)
+    return re.compile("|".join(map(re.escape, ordered)))
+
+
+class PrefixMatcher:
+    """
+    Find the command prefix a message starts with, if any, from the default prefixes or
+    those a guild set for itself. Guild prefixes are stored under `prefixes:<guild id>`
+    and all read once up front, so matching only touches the database to pick up
+    changes made by other processes.
+    """
+
+    prefix = "prefixes:"
+
+    def __init__(self, db: PlyvelDict, default: Iterable[str]):
+        self.db = db
+        self.default = tuple(default)
+        self._stale = set()
+        self._guilds = {
+            int(key[len(self.prefix) :]): tuple(value)
+            for key, value in db.items(prefix=self.prefix)
+        }
+        self._patterns: Dict[Optional[int], Optional[Pattern]] = {}
+        db.watch(self._changed)
+
+    def _changed(self, key: str, exists: bool):
+        """Pick up prefixes another process set, for when running as a cluster."""
+        if key.startswith(self.prefix):
+            guild_id = int(key[len(self.prefix) :])
+
+            if exists:
+                self._stale.add(guild_id)
+            else:
+                self._guilds.pop(guild_id, None)
+
+            self._patterns.pop(guild_id, None)
+
+    def _pattern(self, guild_id: Optional[int]) -> Optional[Pattern]:
+        try:
+            return self._patterns[guild_id]
+        except KeyError:
+            pattern = compile_prefixes(self.get(guild_id))
+            self._patterns[guild_id] = pattern
+            return pattern
+
+    def match(self, message: discord.Message) -> Optional[str]:
+        """Get the prefix `message` starts with, or None if it isn't a command."""
+        pattern = self._pattern(message.guild and message.guild.id)
+        found = pattern and pattern.match(message.content)
+        return found.group() if found else None
+
+    def get(self, guild_id: Optional[int]) -> tuple:
+        if guild_id in self._stale:
+            self._stale.discard(guild_id)
+
+            try:
+                self._guilds[guild_id] = tuple(self.db[self._key(guild_id)])
+            except KeyError:
+                self._guilds.pop(guild_id, None)
+
+        return self._guilds.get(guild_id, self.default)
+
+    def set(self, guild_id: int, prefixes: List[str]):
+        """Replace the prefixes of a guild."""
+        self.db[self._key(guild_id)] = list(prefixes)
+        self._guilds[guild_id] = tuple(prefixes)
+        self._patterns.pop(guild_id, None)
+
+    def reset(self, guild_id: int):
+        """Go back to the default prefixes for a guild."""
+        self._guilds.pop(guild_id, None)
+        self._stale.discard(guild_id)
+        self._patterns.pop(guild_id, None)
+
+        if self._key(guild_id) in self.db:
+            del self.db[self._key(guild_id)]
+
+    def _key(self, guild_id: int) -> str:
+        return f"{self.prefix}{guild_id}"
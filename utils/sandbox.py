@@ -0,0 +1,246 @@
+"""
+Evaluate Python code in separate, pre-started worker processes, so that slow, stuck or
+memory hungry code can't take the bot down with it.
+
+Workers run `python -m utils.sandbox` and exchange length-prefixed pickles over their
+stdin and stdout. A worker that runs past its time limit is killed and replaced.
+Environments come back pickled and are only ever unpickled inside a worker.
+"""
+
+import ast
+import asyncio
+import contextlib
+import copyreg
+import importlib
+import io
+import os
+import pickle
+import struct
+import sys
+import time
+import traceback
+import types
+from typing import NamedTuple, Optional
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+HEADER = struct.Struct("!I")
+MAX_OUTPUT = 8 * 1024 * 1024
+
+
+class EvalResult(NamedTuple):
+    output: str
+    value: Optional[str]
+    error: Optional[str]
+    seconds: float
+    env: Optional[bytes]
+
+
+class SandboxError(Exception):
+    pass
+
+
+def _pickle_module(module: types.ModuleType):
+    return importlib.import_module, (module.__name__,)
+
+
+def _dump_env(env: dict) -> bytes:
+    """Pickle whatever can be, so imports and plain values survive between evals."""
+    copyreg.pickle(types.ModuleType, _pickle_module)
+    kept = {}
+
+    for name, value in env.items():
+        if name == "__builtins__":
+            continue
+
+        try:
+            kept[name] = pickle.dumps(value)
+        except Exception:
+            pass
+
+    return pickle.dumps(kept)
+
+
+def _load_env(data: Optional[bytes]) -> dict:
+    env = {"__name__": "__eval__"}
+
+    for name, value in pickle.loads(data).items() if data else ():
+        try:
+            env[name] = pickle.loads(value)
+        except Exception:
+            pass
+
+    return env
+
+
+def _compile(code: str):
+    """Compile code, keeping the value of a trailing expression like the REPL does."""
+    flags = ast.PyCF_ALLOW_TOP_LEVEL_AWAIT
+    tree = ast.parse(code, "<eval>", "exec")
+
+    if tree.body and isinstance(tree.body[-1], ast.Expr):
+        last = ast.Expression(tree.body.pop().value)
+        return (
+            compile(tree, "<eval>", "exec", flags),
+            compile(last, "<eval>", "eval", flags),
+        )
+
+    return compile(tree, "<eval>", "exec", flags), None
+
+
+def evaluate(code: str, env: Optional[bytes], extra: dict) -> EvalResult:
+    """Run code in a worker. Not meant to be called in the bot's own process."""
+    start = time.perf_counter()
+    namespace = _load_env(env)
+    namespace.update(extra)
+    stdout = io.StringIO()
+    value = error = None
+
+    def run(compiled):
+        result = eval(compiled, namespace)
+        return asyncio.run(result) if asyncio.iscoroutine(result) else result
+
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stdout):
+            body, last = _compile(code)
+            run(body)
+
+            if last is not None:
+                result = run(last)
+                value = None if result is None else repr(result)
+    except BaseException as e:
+        tb = e.__traceback__
+
+        # Hide the sandbox's own frames, unless the code didn't even compile.
+        while tb and tb.tb_frame.f_code.co_filename != "<eval>":
+            tb = tb.tb_next
+
+        error = "".join(traceback.format_exception(type(e), e, tb or e.__traceback__))
+
+    output = stdout.getvalue()[:MAX_OUTPUT]
+    return EvalResult(
+        output, value, error, time.perf_counter() - start, _dump_env(namespace)
+    )
+
+
+def worker(memory: int):
+    """Serve eval requests from stdin until it closes."""
+    if resource and memory:
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+    requests = sys.stdin.buffer
+    replies = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)  # Stray writes to the real stdout mustn't corrupt replies
+
+    while True:
+        header = requests.read(HEADER.size)
+
+        if len(header) < HEADER.size:
+            return
+
+        code, env, extra = pickle.loads(requests.read(HEADER.unpack(header)[0]))
+
+        # Replies are plain tuples, so unpickling them can't run anything.
+        try:
+            reply = pickle.dumps((True, tuple(evaluate(code, env, extra))))
+        except MemoryError:
+            reply = pickle.dumps((False, "Out of memory"))
+
+        replies.write(HEADER.pack(len(reply)) + reply)
+        replies.flush()
+
+
+class _Worker:
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+
+    async def call(self, *request):
+        data = pickle.dumps(request)
+        self.process.stdin.write(HEADER.pack(len(data)) + data)
+        await self.process.stdin.drain()
+        header = await self.process.stdout.readexactly(HEADER.size)
+        reply = await self.process.stdout.readexactly(HEADER.unpack(header)[0])
+        return pickle.loads(reply)
+
+    def kill(self):
+        if self.process.returncode is None:
+            self.process.kill()
+
+
+class Sandbox:
+    """
+    A pool of `size` worker processes evaluating code with a wall clock `timeout` in
+    seconds and an address space limit of `memory` bytes, where supported.
+    """
+
+    def __init__(self, size: int = 2, timeout: float = 10, memory: int = 512 << 20):
+        self.size = size
+        self.timeout = timeout
+        self.memory = memory
+        self._idle = asyncio.Queue()
+        self._workers = set()
+        self._started = False
+
+    async def _spawn(self):
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "utils.sandbox",
+            str(self.memory),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+        worker = _Worker(process)
+        self._workers.add(worker)
+        self._idle.put_nowait(worker)
+
+    async def start(self):
+        """Start the workers ahead of time, so the first eval doesn't wait on them."""
+        if not self._started:
+            self._started = True
+            await asyncio.gather(*(self._spawn() for _ in range(self.size)))
+
+    async def run(self, code: str, env: bytes = None, **extra) -> EvalResult:
+        """
+        Evaluate code in a namespace restored from `env`, a previous result's `env`,
+        plus `extra`, which must be picklable.
+        """
+        await self.start()
+        worker = await self._idle.get()
+
+        try:
+            result = await asyncio.wait_for(worker.call(code, env, extra), self.timeout)
+        except BaseException as e:
+            # The worker is stuck, dead or mid-reply, none of which can be reused.
+            worker.kill()
+            self._workers.discard(worker)
+            asyncio.ensure_future(self._spawn())
+
+            if isinstance(e, asyncio.TimeoutError):
+                raise SandboxError(f"Timed out after {self.timeout} seconds") from None
+            elif isinstance(e, asyncio.IncompleteReadError):
+                raise SandboxError("Worker died, likely out of memory") from None
+
+            raise
+
+        self._idle.put_nowait(worker)
+        ok, result = result
+
+        if not ok:
+            raise SandboxError(result)
+
+        return EvalResult(*result)
+
+    def close(self):
+        for worker in self._workers:
+            worker.kill()
+
+        self._workers.clear()
+
+
+if __name__ == "__main__":
+    worker(int(sys.argv[1]))
@@ -0,0 +1,121 @@
+import marshal
+import pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Pickle output always starts with its PROTO opcode, so pickled values double as their
+# own format byte and databases written before codecs existed stay readable as-is.
+PICKLE = pickle.PROTO
+MARSHAL = b"m"
+MSGPACK = b"M"
+
+_unsupported = (TypeError, ValueError, OverflowError)
+
+
+class Codec:
+    """
+    Encoding for stored values. Every encoded value starts with the codec's `tag` byte,
+    so values written by different codecs can live side by side.
+    """
+
+    name = None
+    tag = None
+
+    def encode(self, value) -> bytes:
+        """Encode a value, raising TypeError or ValueError if it isn't supported."""
+        raise NotImplementedError
+
+    def decode(self, data: bytes):
+        raise NotImplementedError
+
+
+class PickleCodec(Codec):
+    """Handles anything picklable, used as the fallback for every other codec."""
+
+    name = "pickle"
+    tag = PICKLE
+
+    def encode(self, value) -> bytes:
+        return pickle.dumps(value)
+
+    def decode(self, data: bytes):
+        return pickle.loads(data)
+
+
+class MarshalCodec(Codec):
+    """
+    Fast and compact for builtin types (dict, list, tuple, set, int, str, bytes, ...).
+    The format can change between Python versions, so run `utils.migrate` to switch
+    back to pickle before upgrading if unsure.
+    """
+
+    name = "marshal"
+    tag = MARSHAL
+
+    def encode(self, value) -> bytes:
+        return self.tag + marshal.dumps(value)
+
+    def decode(self, data: bytes):
+        return marshal.loads(memoryview(data)[1:])
+
+
+class MsgpackCodec(Codec):
+    """
+    Portable and compact for plain dict/list/int/str/float/bool/None/bytes values.
+    Requires the optional `msgpack` package.
+    """
+
+    name = "msgpack"
+    tag = MSGPACK
+
+    def encode(self, value) -> bytes:
+        # strict_types refuses tuples and subclasses rather than changing their type.
+        return self.tag + msgpack.packb(value, use_bin_type=True, strict_types=True)
+
+    def decode(self, data: bytes):
+        return msgpack.unpackb(
+            memoryview(data)[1:], raw=False, strict_map_key=False, use_list=True
+        )
+
+
+CODECS = {codec.name: codec for codec in (PickleCodec, MarshalCodec, MsgpackCodec)}
+
+
+class Serializer:
+    """
+    Encodes with the preferred codec, falling back to pickle for values it can't
+    handle, and decodes anything written by any codec.
+    """
+
+    def __init__(self, codec: str = "pickle"):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec `{codec}`, must be one of {list(CODECS)}")
+        elif codec == "msgpack" and msgpack is None:
+            raise ValueError("The msgpack codec requires the `msgpack` package")
+
+        self.codec = CODECS[codec]()
+        self._pickle = PickleCodec()
+        self._decoders = {PICKLE: self._pickle.decode, MARSHAL: MarshalCodec().decode}
+
+        if msgpack is not None:
+            self._decoders[MSGPACK] = MsgpackCodec().decode
+
+    def dumps(self, value) -> bytes:
+        if self.codec.tag != PICKLE:
+            try:
+                return self.codec.encode(value)
+            except _unsupported:
+                pass
+
+        return self._pickle.encode(value)
+
+    def loads(self, data: bytes):
+        try:
+            decode = self._decoders[data[:1]]
+        except KeyError:
+            raise ValueError(f"Unknown value format {data[:1]!r}") from None
+
+        return decode(data)
@@ -0,0 +1,100 @@
+import asyncio
+import importlib.util
+import re
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Tuple
+
+
+class Timings:
+    """Wall clock time spent in each named phase of startup, in the order they ran."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def record(self, name: str, seconds: float):
+        self.phases[name] = seconds
+
+    def report(self) -> str:
+        width = max(map(len, self.phases), default=0)
+        lines = [f"{name:<{width}} {secs * 1000:>9.1f} ms" for name, secs in self]
+        total = sum(self.phases.values())
+        return "\n".join([*lines, f"{'total':<{width}} {total * 1000:>9.1f} ms"])
+
+    def __iter__(self):
+        return iter(self.phases.items())
+
+
+# Imports at the top level of a module: unindented, so not those in `if TYPE_CHECKING:`.
+IMPORT = re.compile(
+    r"^(?:import\s+([\w., ]+)|from\s+([\w.]+)\s+import\s+(?:\(([^)]*)\)|([\w, ]+)))",
+    re.M,
+)
+
+
+def dependencies(module: str) -> Dict[str, Tuple[str, ...]]:
+    """
+    The absolute imports at the top level of `module`, found in its source without
+    running it, mapped to the names imported from them.
+    """
+    try:
+        spec = importlib.util.find_spec(module)
+    except (ImportError, ValueError):
+        return {}
+
+    if spec is None or not (spec.origin or "").endswith(".py"):
+        return {}
+
+    with open(spec.origin, encoding="utf-8") as f:
+        source = f.read()
+
+    imports = {}
+
+    for modules, from_, wrapped, names in IMPORT.findall(source):
+        # Only the first word of each, to leave out `as` aliases.
+        if modules:
+            imports.update((x.split()[0], ()) for x in modules.split(","))
+        else:
+            names = (wrapped or names).split(",")
+            names = tuple(x.split()[0] for x in names if x.strip())
+            imports[from_] = imports.get(from_, ()) + names
+
+    return imports
+
+
+def _import(name: str, fromlist: Tuple[str, ...]):
+    try:
+        # Also imports the submodules in `fromlist`, as `from name import x` would.
+        __import__(name, fromlist=fromlist)
+    except Exception:
+        pass  # Left for loading the extension to report
+
+
+async def preimport(modules: Iterable[str]):
+    """
+    Import what `modules` depend on concurrently on worker threads, so loading them
+    afterwards finds it in `sys.modules`. The modules themselves aren't imported:
+    `load_extension` always runs them again from their source.
+    """
+    imports = {}
+
+    for module in modules:
+        for name, fromlist in dependencies(module).items():
+            if name not in sys.modules or fromlist:
+                imports[name] = imports.get(name, ()) + fromlist
+
+    loop = asyncio.get_event_loop()
+    await asyncio.gather(
+        *(loop.run_in_executor(None, _import, *item) for item in imports.items())
+    )
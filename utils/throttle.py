@@ -0,0 +1,120 @@
+import time
+from collections import Counter
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+
+class Throttle:
+    """
+    Token bucket allowing `rate` hits per `per` seconds per key, with bursts of up to
+    `rate`. Implemented as GCRA, so each key costs a single float: the time its bucket
+    will be full again. Keys whose bucket has refilled hold no state worth keeping, and
+    are dropped by `evict`.
+    """
+
+    __slots__ = ("interval", "tolerance", "_full_at")
+
+    def __init__(self, rate: int, per: float):
+        self.interval = per / rate
+        self.tolerance = per - self.interval
+        self._full_at: Dict[Hashable, float] = {}
+
+    def hit(self, key: Hashable, now: float) -> bool:
+        """Take a token for `key`, returning False if there was none left."""
+        full_at = max(self._full_at.get(key, now), now)
+
+        if full_at - now > self.tolerance:
+            return False
+
+        self._full_at[key] = full_at + self.interval
+        return True
+
+    def evict(self, now: float):
+        self._full_at = {k: v for k, v in self._full_at.items() if v > now}
+
+    def __len__(self):
+        return len(self._full_at)
+
+
+class Throttler:
+    """
+    Per-user, per-guild and optional per-command throttles checked before a message is
+    parsed into a command. Limits are `(rate, per seconds)` pairs, or None for none.
+    Users dropped more than `offender_limit` times a minute are passed to `on_offender`.
+    """
+
+    def __init__(
+        self,
+        user: Optional[Tuple[int, float]] = (5, 10),
+        guild: Optional[Tuple[int, float]] = (30, 10),
+        commands: Dict[str, Tuple[int, float]] = None,
+        offender_limit: int = 0,
+        on_offender: Callable[[int], None] = None,
+        evict_interval: float = 60,
+    ):
+        self.user = Throttle(*user) if user else None
+        self.guild = Throttle(*guild) if guild else None
+        self.commands = {name: Throttle(*x) for name, x in (commands or {}).items()}
+        self.offenders = Throttle(offender_limit, 60) if offender_limit else None
+        self.on_offender = on_offender
+        self.evict_interval = evict_interval
+        self.dropped = Counter()
+        self._evicted_at = time.monotonic()
+
+    def _drop(self, reason: str, user_id: int, now: float) -> bool:
+        self.dropped[reason] += 1
+
+        if self.offenders is not None and not self.offenders.hit(user_id, now):
+            self.dropped["offender"] += 1
+
+            if self.on_offender is not None:
+                self.on_offender(user_id)
+
+        return False
+
+    def allow(self, user_id: int, guild_id: Optional[int], command: str = None) -> bool:
+        """Check and take from every throttle that applies to a command invocation."""
+        now = time.monotonic()
+
+        if now - self._evicted_at > self.evict_interval:
+            self.evict(now)
+
+        # Per-command limits come first, so a throttled command doesn't use up the
+        # user's and guild's budget for other commands.
+        throttle = self.commands.get(command)
+
+        if throttle is not None and not throttle.hit((command, user_id), now):
+            return self._drop("command", user_id, now)
+        if self.user is not None and not self.user.hit(user_id, now):
+            return self._drop("user", user_id, now)
+        if (
+            self.guild is not None
+            and guild_id is not None
+            and not self.guild.hit(guild_id, now)
+        ):
+            return self._drop("guild", user_id, now)
+
+        return True
+
+    def evict(self, now: float = None):
+        """Forget idle buckets, which would be full again anyway."""
+        now = time.monotonic() if now is None else now
+        self._evicted_at = now
+
+        for throttle in (
+            self.user,
+            self.guild,
+            self.offenders,
+            *self.commands.values(),
+        ):
+            if throttle is not None:
+                throttle.evict(now)
+
+    def stats(self) -> dict:
+        return {
+            "dropped": dict(self.dropped),
+            "buckets": {
+                "user": len(self.user or ()),
+                "guild": len(self.guild or ()),
+                "command": sum(map(len, self.commands.values())),
+            },
+        }
@@ -0,0 +1,96 @@
+import asyncio
+from typing import Dict, Iterable, Optional
+
+import discord
+
+from utils.database import AsyncPlyvelDict
+
+
+class UserResolver:
+    """
+    Resolve user ids to `name#discriminator`, trying the client's cache, then names
+    persisted in the database for up to `ttl` seconds, and only then the API, with at
+    most `concurrency` requests in flight. Unknown users resolve to None.
+    """
+
+    prefix = "usercache:"
+
+    def __init__(
+        self,
+        client: discord.Client,
+        db: AsyncPlyvelDict,
+        ttl: float = 24 * 60 * 60,
+        concurrency: int = 10,
+    ):
+        self.client = client
+        self.db = db
+        self.ttl = ttl
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def _key(self, user_id: int) -> str:
+        return f"{self.prefix}{user_id}"
+
+    def _read_cached(self, ids) -> Dict[int, Optional[str]]:
+        """Get cached names. Blocking, run on the database's pool."""
+        found = {}
+
+        for user_id in ids:
+            try:
+                found[user_id] = self.db.db[self._key(user_id)]
+            except KeyError:
+                pass
+
+        return found
+
+    def _write_cached(self, names: Dict[int, Optional[str]]):
+        with self.db.db.batch():
+            for user_id, name in names.items():
+                self.db.db.set(self._key(user_id), name, ttl=self.ttl)
+
+    async def _fetch(self, user_id: int) -> Optional[str]:
+        async with self._semaphore:
+            try:
+                user = await self.client.fetch_user(user_id)
+            except discord.NotFound:
+                return None
+
+        return str(user)
+
+    async def resolve_many(self, ids: Iterable[int]) -> Dict[int, Optional[str]]:
+        """Resolve many ids at once, keeping their order."""
+        ids = list(ids)
+        names = {}
+
+        for user_id in ids:
+            user = self.client.get_user(user_id)
+
+            if user is not None:
+                names[user_id] = str(user)
+
+        missing = [x for x in ids if x not in names]
+
+        if missing:
+            names.update(await self.db.run(self._read_cached, missing))
+            missing = [x for x in missing if x not in names]
+
+        if missing:
+            results = await asyncio.gather(
+                *(self._fetch(x) for x in missing), return_exceptions=True
+            )
+            fetched = {}
+
+            for user_id, result in zip(missing, results):
+                if isinstance(result, discord.HTTPException):
+                    names[user_id] = None  # Likely transient, so don't remember it
+                elif isinstance(result, BaseException):
+                    raise result
+                else:
+                    fetched[user_id] = names[user_id] = result
+
+            if fetched:
+                await self.db.run(self._write_cached, fetched)
+
+        return {user_id: names[user_id] for user_id in ids}
+
+    async def resolve(self, user_id: int) -> Optional[str]:
+        return (await self.resolve_many([user_id]))[user_id]
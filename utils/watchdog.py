@@ -0,0 +1,137 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import List, Optional, Tuple
+
+from utils.memory import short_path
+from utils.metrics import OperationStats
+
+Site = Tuple[Tuple[str, int, str], ...]  # Innermost frames as (file, line, function)
+
+
+class LoopWatchdog:
+    """
+    Measure how late the event loop wakes up from a sleep of `interval` seconds, and
+    once it's running `threshold` seconds behind, sample the stack of whatever blocks
+    it from a helper thread every `interval` until it catches up. Samples are counted
+    per call site of their innermost `depth` frames, so a site's count times `interval`
+    roughly gives the time it kept the loop blocked. At most `max_sites` are tracked.
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.1,
+        threshold: float = 0.25,
+        depth: int = 6,
+        max_sites: int = 500,
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.depth = depth
+        self.max_sites = max_sites
+        self.lag = OperationStats()
+        self.worst = 0.0
+        self.stalls = 0
+        self.samples: Counter = Counter()
+        self.since = time.time()
+        self._lock = threading.Lock()
+        self._beat = time.monotonic()
+        self._thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop: Optional[threading.Event] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self):
+        """Start watching the running event loop. Call from the loop's thread."""
+        if self._task is not None:
+            return
+
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop = threading.Event()
+        self._task = asyncio.ensure_future(self._heartbeat())
+        threading.Thread(
+            target=self._watch, args=(self._stop,), name="Loop watchdog", daemon=True
+        ).start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._stop.set()
+
+    async def _heartbeat(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._beat = now = time.monotonic()
+            lag = max(now - start - self.interval, 0.0)
+            self.lag.record(lag, 0)
+            self.worst = max(self.worst, lag)
+
+    def _watch(self, stop: threading.Event):
+        stalled_at = None  # Beat the current stall started after
+
+        while not stop.wait(self.interval):
+            beat = self._beat
+
+            if time.monotonic() - beat - self.interval < self.threshold:
+                continue
+
+            frame = sys._current_frames().get(self._thread_id)
+
+            if frame is None:
+                continue
+
+            site = tuple(
+                (x.filename, x.lineno, x.name)
+                for x in traceback.extract_stack(frame, self.depth)
+            )
+            del frame
+
+            with self._lock:
+                if stalled_at != beat:
+                    stalled_at = beat
+                    self.stalls += 1
+
+                if site not in self.samples and len(self.samples) >= self.max_sites:
+                    site = (("<other>", 0, ""),)
+
+                self.samples[site] += 1
+
+    def worst_sites(self, limit: int = 5) -> List[Tuple[Site, int]]:
+        with self._lock:
+            return self.samples.most_common(limit)
+
+    def reset(self):
+        with self._lock:
+            self.lag = OperationStats()
+            self.worst = 0.0
+            self.stalls = 0
+            self.samples.clear()
+            self.since = time.time()
+
+    def report(self, limit: int = 5) -> str:
+        """Describe the lag seen and the call sites which blocked the loop the most."""
+        lines = [
+            f"Lag p50 {self.lag.percentile(50) * 1000:.1f} ms, "
+            f"p99 {self.lag.percentile(99) * 1000:.1f} ms, "
+            f"worst {self.worst * 1000:.0f} ms over {self.lag.count} beats",
+            f"Stalls over {self.threshold * 1000:.0f} ms: {self.stalls}",
+        ]
+
+        for site, count in self.worst_sites(limit):
+            lines.append("")
+            lines.append(f"~{count * self.interval * 1000:.0f} ms in {count} samples:")
+            lines += [
+                f"  {short_path(filename)}:{lineno} in {name}"
+                for filename, lineno, name in reversed(site)
+            ]
+
+        return "\n".join(lines)